@@ -15,13 +15,14 @@ Requires:	echoprint-codegen
 Requires:	ofono
 Requires:	pulseaudio
 Requires:	pulseaudio-module-bluetooth
+Requires:	pulseaudio-libs
 Requires:	pulseaudio-utils
 Requires:	python3
 Requires:	python3-dbus
 Requires:	python3-gobject
+Requires:	python3-numpy
 Requires:	python3-pyxdg
 Requires:	sox
-Requires:	minimodem
 BuildRequires:	java-1.7.0-openjdk
 BuildRequires:	python2-devel
 BuildRequires:	saxon
@@ -70,19 +71,30 @@ make install DESTDIR=%{buildroot}
 %{_exec_prefix}/lib/tmpfiles.d/btts.conf
 %{_exec_prefix}/lib/btts/*
 %{_libexecdir}/%{name}/btts-*
+%{_libexecdir}/%{name}/batch
+%{_libexecdir}/%{name}/command-client
+%{_libexecdir}/%{name}/command-server
 %{_libexecdir}/%{name}/environment
 %{_libexecdir}/%{name}/environment.sh
 %{_datadir}/%{name}/*
 %{_datadir}/glib-2.0/schemas/*
 %{_unitdir}/btts-bluez-agent.service
+%{_unitdir}/btts-command-server.service
 %{_unitdir}/btts-bluez-pairing-tool.service
 %{_unitdir}/btts-a2dp-tool.service
 %{_unitdir}/btts-dbus.service
+%{_unitdir}/btts-device-tool.service
 %{_unitdir}/btts-hfp-tool.service
 %{_unitdir}/btts-opp-client-tool.service
 %{_unitdir}/btts-opp-server-tool.service
 %{_unitdir}/btts-pulseaudio.service
 %{_unitdir}/btts.target
+%{_unitdir}/btts-session@.target
+%{_unitdir}/btts-bluez-pairing-tool@.service
+%{_unitdir}/btts-a2dp-tool@.service
+%{_unitdir}/btts-device-tool@.service
+%{_unitdir}/btts-hfp-tool@.service
+%{_unitdir}/btts-opp-client-tool@.service
 %config %{_sysconfdir}/dbus-1/system.d/btts.conf
 
 %defattr(0664, btts, btts, 0755)
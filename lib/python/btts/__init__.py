@@ -25,28 +25,70 @@ __all__ = [
 
            # from device
            'Device',
+           'PresenceTracker',
 
            # from audio
+           'EchoLatency',
            'Echonest',
            'Minimodem',
+           'Monitor',
            'Player',
            'Recorder',
+           'SampleCache',
+           'SampleLibrary',
 
            # from mediacontrol
            'MediaControl',
 
            # from voicecall
+           'CallTracker',
            'VoiceCall',
            ]
 
+import importlib
 import sys
 
 import btts.cliutils
 import btts.utils
 
-from btts.adapter import Adapter
-from btts.config import Config
-from btts.device import Device
-from btts.audio import Echonest, Minimodem, Player, Recorder
-from btts.mediacontrol import MediaControl
-from btts.voicecall import VoiceCall
+# Submodules are imported on first access to any of their public names, so
+# that commands only pay for what they use.
+_module_by_name = {
+        'Adapter': 'btts.adapter',
+        'Config': 'btts.config',
+        'Device': 'btts.device',
+        'PresenceTracker': 'btts.device',
+        'EchoLatency': 'btts.audio',
+        'Echonest': 'btts.audio',
+        'Minimodem': 'btts.audio',
+        'Monitor': 'btts.audio',
+        'Player': 'btts.audio',
+        'Recorder': 'btts.audio',
+        'SampleCache': 'btts.audio',
+        'SampleLibrary': 'btts.audio',
+        'MediaControl': 'btts.mediacontrol',
+        'CallTracker': 'btts.voicecall',
+        'VoiceCall': 'btts.voicecall',
+        }
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        try:
+            module_name = _module_by_name[name]
+        except KeyError:
+            raise AttributeError("module '%s' has no attribute '%s'"
+                                 % (__name__, name))
+        value = getattr(importlib.import_module(module_name), name)
+        globals()[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(_module_by_name))
+else:
+    from btts.adapter import Adapter
+    from btts.config import Config
+    from btts.device import Device, PresenceTracker
+    from btts.audio import (EchoLatency, Echonest, Minimodem, Monitor,
+                            Player, Recorder, SampleCache, SampleLibrary)
+    from btts.mediacontrol import MediaControl
+    from btts.voicecall import CallTracker, VoiceCall
@@ -23,6 +23,7 @@ import subprocess
 import sys
 
 import btts
+import btts.bus
 
 class Adapter:
     FEATURES = [
@@ -36,19 +37,13 @@ class Adapter:
         self._adapter_object = None
         self._properties_iface = None
 
-        bus = dbus.SystemBus()
-        manager = dbus.Interface(bus.get_object("org.bluez", "/"),
-                                 "org.freedesktop.DBus.ObjectManager")
-        objects = manager.GetManagedObjects()
-        for path, properties in objects.items():
-            adapter_properties = properties.get('org.bluez.Adapter1')
-            if adapter_properties is not None and path.endswith(name):
-                self._adapter_object = bus.get_object('org.bluez', path)
-                self._adapter_iface = dbus.Interface(self._adapter_object,
-                                                     'org.bluez.Adapter1')
-                self._properties_iface = dbus.Interface(self._adapter_object,
-                                                        dbus.PROPERTIES_IFACE)
-                break
+        path = btts.bus.ObjectTree.instance().adapter_path(name)
+        if path is not None:
+            self._adapter_object = btts.bus.get_object('org.bluez', path)
+            self._adapter_iface = dbus.Interface(self._adapter_object,
+                                                 'org.bluez.Adapter1')
+            self._properties_iface = dbus.Interface(self._adapter_object,
+                                                    dbus.PROPERTIES_IFACE)
 
     def _ensure_ready(self):
         if not self._adapter_object:
@@ -97,11 +92,7 @@ class Adapter:
     def scan(self, refresh=False):
         self._ensure_ready()
 
-        try:
-            self._adapter_iface.StopDiscovery()
-        except dbus.DBusException as e:
-            if e.get_dbus_name() != 'org.bluez.Error.Failed':
-                raise e
+        self.stop_discovery()
 
         name = self._config.adapter_no_alias
         args = ['hcitool', '-i', name, 'scan', '--flush']
@@ -115,6 +106,54 @@ class Adapter:
             if e.get_dbus_name() != 'org.bluez.Error.InProgress':
                 raise e
 
+    def start_discovery(self, address=None):
+        '''
+        Start discovery, limited to the device with the given address where
+        bluez supports that (org.bluez.Adapter1.SetDiscoveryFilter, 'Pattern'
+        key). Duplicate reports are requested, so RSSI updates keep coming for
+        devices already found.
+
+        Unlike scan() this does not block - watch for the device to appear
+        (btts.Device.available_changed). Both the filter and the discovery
+        end when this process disconnects from the bus.
+        '''
+        self._ensure_ready()
+
+        discovery_filter = {'Transport': 'auto', 'DuplicateData': True}
+        if address:
+            discovery_filter['Pattern'] = address.upper()
+
+        try:
+            self._adapter_iface.SetDiscoveryFilter(
+                    dbus.Dictionary(discovery_filter, signature='sv'))
+        except dbus.DBusException as e:
+            error_name = e.get_dbus_name()
+            if error_name == 'org.bluez.Error.InvalidArguments':
+                # 'Pattern' and 'DuplicateData' are newer than the method
+                self._adapter_iface.SetDiscoveryFilter(
+                        dbus.Dictionary({'Transport': 'auto'}, signature='sv'))
+            elif error_name != 'org.freedesktop.DBus.Error.UnknownMethod':
+                raise e
+
+        try:
+            self._adapter_iface.StartDiscovery()
+        except dbus.DBusException as e:
+            if e.get_dbus_name() != 'org.bluez.Error.InProgress':
+                raise e
+
+    def stop_discovery(self):
+        '''
+        Stop discovery started by this process, if any. Discovery started by
+        other processes continues.
+        '''
+        self._ensure_ready()
+
+        try:
+            self._adapter_iface.StopDiscovery()
+        except dbus.DBusException as e:
+            if e.get_dbus_name() != 'org.bluez.Error.Failed':
+                raise e
+
     @property
     def adapter_iface(self):
         self._ensure_ready()
@@ -18,14 +18,31 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import collections
+import glob
+import hashlib
+import itertools
 import json
 import logging
 import math
+import os
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import re
+import select
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+import wave
 
 import btts
+import btts.pulse
+import btts.utils
 
 log = logging.getLogger(__name__)
 
@@ -36,63 +53,1088 @@ _pa_profile_by_bt_profile = {
     'a2dp': 'a2dp_source',
 }
 
+def _exact_duration(file_path):
+    return float(subprocess.check_output(['soxi', '-D', file_path]))
+
 def _duration(file_path):
-    duration = subprocess.check_output(['soxi', '-D', file_path])
-    duration = math.floor(float(duration))
-    return duration
+    return math.floor(_exact_duration(file_path))
 
 # TODO: error handling
 class Echonest:
+    '''
+    Audio fingerprinting and matching.
+
+    Fingerprints are computed by a backend selected with the
+    BTTS_FINGERPRINT_BACKEND environment variable:
+
+        echoprint - echoprint-codegen (default)
+        spectral  - in-process spectral landmarks, see btts.fingerprint
+
+    Codes produced by different backends are not comparable.
+    '''
+
     _MIN_CODE_LEN = 10
-    _THRESHOLD = 0.5 # Percent match required
+    _DEFAULT_BACKEND = 'echoprint'
+
+    class Error(Exception):
+        _dbus_error_name = 'org.merproject.btts.Echonest.Error'
+
+    class NoSuchBackendError(Error):
+        def __init__(self, backend):
+            Echonest.Error.__init__(self, '%s: No such fingerprint backend'
+                                          % (backend))
+
+    class EchoprintBackend:
+        name = 'echoprint'
+        # Portion of hashes agreeing on the alignment required. See
+        # tools/bench-fingerprint.
+        threshold = 0.1
+        # Time offsets are in units of the echoprint hop size
+        offset_unit = 256 / 11025 # seconds
+        # Duration fingerprinted by default
+        default_duration = 30 # seconds
+
+        def codegen(self, file_path, start=0, duration=None):
+            if duration is None:
+                duration = self.default_duration
+            cmd = ['echoprint-codegen', file_path, str(int(start)),
+                   str(int(math.ceil(duration)))]
+            env = {'BTTS_ECHOPRINT_NOCOMPRESS': '1'}
+            proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE, env=env)
+            out = proc.communicate()[0]
+            #log.debug('json: [[[%s]]]' % (out.decode('utf-8')), file=sys.stderr)
+            data = json.loads(out.decode('utf-8'))
+            code = data[0]['code']
+
+            return code
+
+        def codegen_pcm(self, data, rate, channels=1):
+            with tempfile.NamedTemporaryFile(suffix='.wav') as wav_file:
+                write_wav(wav_file.name, data, rate, channels)
+                return self.codegen(wav_file.name)
+
+    _backends = {}
+
+    @staticmethod
+    def backend(name=None):
+        if name is None:
+            name = os.environ.get('BTTS_FINGERPRINT_BACKEND',
+                                  Echonest._DEFAULT_BACKEND)
+
+        if name not in Echonest._backends:
+            if name == 'echoprint':
+                backend = Echonest.EchoprintBackend()
+            elif name == 'spectral':
+                # Pulls in numpy - only when needed
+                import btts.fingerprint
+                backend = btts.fingerprint.SpectralBackend()
+            else:
+                raise Echonest.NoSuchBackendError(name)
+            Echonest._backends[name] = backend
+
+        return Echonest._backends[name]
 
     @staticmethod
-    def match_code_string(wanted, tested):
-        wanted_keys = set(wanted.split(" ")[0::2])
-        tested_keys = tested.split(" ")[0::2]
-        assert(len(wanted_keys) >= Echonest._MIN_CODE_LEN)
-        assert(len(tested_keys) >= Echonest._MIN_CODE_LEN)
-        match = list(filter(lambda x: x in wanted_keys, tested_keys))
-        match_len = len(match)
-        total_len = len(tested_keys)
-        log.info('Matched %d%% samples (%d out of %d). Threshold %d%%.'
-                 % ((match_len / total_len) * 100, match_len, total_len,
-                     Echonest._THRESHOLD * 100))
-        return match_len >= total_len * Echonest._THRESHOLD
+    def parse_code(code):
+        '''
+        Returns the list of (hash, offset) pairs of a code string.
+        '''
+        values = code.split()
+        return list(zip(values[0::2], map(int, values[1::2])))
+
+    @staticmethod
+    def match_code_string(wanted, tested, threshold=None):
+        library = SampleLibrary()
+        library.add('wanted', wanted)
+        tested_pairs = Echonest.parse_code(tested)
+        assert(len(tested_pairs) >= Echonest._MIN_CODE_LEN)
+        histogram = library.histogram()
+        histogram.feed(tested_pairs)
+        return histogram.matches('wanted', threshold)
+
+    class IncrementalMatcher:
+        '''
+        Matches audio fingerprinted window by window against a sample.
+
+        Feed codes of consecutive windows with feed(). It returns True as soon
+        as the audio fed so far matches and keeps matching for at least
+        `confirm' more seconds.
+        '''
+
+        def __init__(self, library, name, confirm=0):
+            self._histogram = library.histogram([name])
+            self._name = name
+            self._confirm = confirm
+            self._offset_unit = Echonest.backend().offset_unit
+            self.duration = 0
+            self.matched_at = None
+
+        def feed(self, code, duration):
+            # Offsets are relative to the start of the window
+            shift = int(round(self.duration / self._offset_unit))
+            self._histogram.feed(Echonest.parse_code(code), shift)
+            self.duration += duration
+
+            if self.matches():
+                if self.matched_at is None:
+                    self.matched_at = self.duration
+            else:
+                self.matched_at = None
+
+            return (self.matched_at is not None
+                    and self.duration - self.matched_at >= self._confirm)
+
+        def matches(self):
+            if self._histogram.total < Echonest._MIN_CODE_LEN:
+                return False
+            return self._histogram.matches(self._name)
+
+    class Segmenter:
+        '''
+        Fingerprints long audio in overlapping segments, concurrently on a
+        pool of 'workers' processes (one per CPU by default, none with
+        'workers' == 1).
+
+        Segments are 'segment' seconds long and each overlaps the previous
+        one by 'overlap' seconds, so that no landmark is lost at segment
+        boundaries. Segment codes are merged into a code of the whole audio
+        with merge(), or matched one by one with scores() to see where the
+        audio stops matching.
+
+        Use as a context manager to release the pool.
+        '''
+
+        Segment = collections.namedtuple('Segment', 'start duration code')
+
+        def __init__(self, segment=30, overlap=5, workers=None):
+            assert(0 <= overlap < segment)
+            self._segment = segment
+            self._overlap = overlap
+            self._workers = workers
+            self._executor = None
+            self._backend = Echonest.backend()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            self.close()
+
+        def close(self):
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+        def segments(self, duration):
+            '''
+            Returns the list of (start, duration) segments of audio of the
+            given duration [secs].
+            '''
+            segments = []
+            start = 0
+            while True:
+                segments.append((start, min(self._segment, duration - start)))
+                if start + self._segment >= duration:
+                    return segments
+                start += self._segment - self._overlap
+
+        def codegen(self, file_path):
+            '''
+            Returns the list of Segments of the audio file, ordered by start.
+            '''
+            segments = self.segments(math.ceil(_exact_duration(file_path)))
+            if len(segments) == 1 or self._workers == 1:
+                return [self.Segment(start, duration,
+                                     self._backend.codegen(file_path, start,
+                                                           duration))
+                        for start, duration in segments]
+
+            futures = [(start, duration,
+                        self.submit(file_path, start, duration))
+                       for start, duration in segments]
+            return [self.Segment(start, duration, future.result())
+                    for start, duration, future in futures]
+
+        def submit(self, file_path, start=0, duration=None):
+            '''
+            Fingerprint a single segment in background. Returns a
+            concurrent.futures.Future of its code.
+
+            Suitable to fingerprint windows of a live stream as they complete.
+            Then 'start' is the position of the window in the stream.
+            '''
+            if self._executor is None:
+                # Pulls in multiprocessing - only when needed
+                import concurrent.futures
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                        self._workers)
+            if duration is None:
+                duration = _exact_duration(file_path)
+            return self._executor.submit(_codegen_segment, self._backend.name,
+                                         file_path, start, duration)
+
+        def merge(self, segments):
+            '''
+            Merge codes of consecutive segments into a single code with
+            offsets relative to the start of the first one.
+
+            Of the overlapping parts each segment contributes one half.
+            '''
+            unit = self._backend.offset_unit
+            first = segments[0].start
+            merged = []
+            for i, segment in enumerate(segments):
+                low = (segment.start + self._overlap / 2 if i > 0
+                       else float('-inf'))
+                high = (segment.start + segment.duration - self._overlap / 2
+                        if i < len(segments) - 1 else float('inf'))
+                shift = int(round((segment.start - first) / unit))
+                for code_hash, offset in Echonest.parse_code(segment.code):
+                    if low <= segment.start + offset * unit < high:
+                        merged.append((code_hash, offset + shift))
+            return ' '.join('%s %d' % pair for pair in merged)
+
+        @staticmethod
+        def scores(library, name, segments):
+            '''
+            Match each segment against the named sample on its own. Returns
+            the list of (start, score, alignment) triplets, see
+            SampleLibrary.identify().
+            '''
+            scores = []
+            for segment in segments:
+                histogram = library.histogram([name])
+                histogram.feed(Echonest.parse_code(segment.code))
+                result_name, score, alignment = histogram.results()[0]
+                scores.append((segment.start, score, alignment))
+            return scores
 
     @staticmethod
     def codegen(file_path):
-        cmd = ['echoprint-codegen', file_path, '0', '30']
-        env = {'BTTS_ECHOPRINT_NOCOMPRESS': '1'}
-        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
-                                stdout=subprocess.PIPE, env=env)
-        out = proc.communicate()[0]
-        #log.debug('json: [[[%s]]]' % (out.decode('utf-8')), file=sys.stderr)
-        data = json.loads(out.decode('utf-8'))
-        code = data[0]['code']
+        return Echonest.backend().codegen(file_path)
+
+    @staticmethod
+    def codegen_pcm(data, rate, channels=1):
+        '''
+        Fingerprint interleaved signed 16 bit little endian PCM data.
+        '''
+        return Echonest.backend().codegen_pcm(data, rate, channels)
+
+def _codegen_segment(backend_name, file_path, start, duration):
+    # Echonest.Segmenter process pool worker
+    return Echonest.backend(backend_name).codegen(file_path, start, duration)
+
+class SampleLibrary:
+    '''
+    Named audio samples to match recorded audio against.
+
+    Stored as an inverted index: fingerprint hash -> list of (sample, offset)
+    pairs. Audio is matched by building, for each sample, the histogram of
+    differences between the sample offsets and the tested offsets of the
+    common hashes. When the audio comes from the sample, most common hashes
+    agree on the difference - the time alignment - while hashes matched by
+    chance spread over the whole histogram. The score is the portion of the
+    tested hashes falling at the peak of the histogram.
+
+    Fingerprints are computed by the btts.Echonest backend. The library is
+    discarded when the backend changes.
+    '''
+
+    _VERSION = 1
+    _BIN = 2 # offset units; the peak spans two bins to tolerate jitter
+
+    class Error(Exception):
+        _dbus_error_name = 'org.merproject.btts.SampleLibrary.Error'
+
+    class NoSuchSampleError(Error):
+        def __init__(self, name):
+            if name is None:
+                SampleLibrary.Error.__init__(self, 'No sample set')
+            else:
+                SampleLibrary.Error.__init__(self, '%s: No such sample' % (name))
+            self.name = name
+
+    class SampleTooShortError(Error):
+        def __init__(self, name, length):
+            SampleLibrary.Error.__init__(
+                    self, '%s: Sample too short to match against (%d hashes, '
+                          'at least %d needed)'
+                          % (name, length, Echonest._MIN_CODE_LEN))
+            self.name = name
+
+    def __init__(self, path=None):
+        self._path = path
+        self._backend = Echonest.backend()
+        self.clear()
+        if path is not None:
+            self._load()
+
+    def clear(self):
+        # Sample ids index _names; removed samples leave None behind
+        self._names = []
+        self._index = {}
+        self.current = None
+
+    def names(self):
+        return [name for name in self._names if name is not None]
+
+    def add(self, name, code):
+        '''
+        Add sample, replacing any sample of the same name. The sample added
+        last becomes the current one. Raises SampleTooShortError when the
+        code is too short to match against.
+        '''
+        pairs = Echonest.parse_code(code)
+        if len(pairs) < Echonest._MIN_CODE_LEN:
+            raise self.SampleTooShortError(name, len(pairs))
+
+        if name in self._names:
+            self.remove(name)
+
+        sample_id = len(self._names)
+        self._names.append(name)
+        for code_hash, offset in pairs:
+            self._index.setdefault(code_hash, []).append((sample_id, offset))
+
+        self.current = name
+
+    def remove(self, name):
+        if name not in self._names:
+            raise self.NoSuchSampleError(name)
+
+        sample_id = self._names.index(name)
+        self._names[sample_id] = None
+        for code_hash in list(self._index.keys()):
+            entries = [entry for entry in self._index[code_hash]
+                       if entry[0] != sample_id]
+            if entries:
+                self._index[code_hash] = entries
+            else:
+                del self._index[code_hash]
+
+        if self.current == name:
+            self.current = None
+
+    def save(self):
+        data = {
+                'version': self._VERSION,
+                'backend': self._backend.name,
+                'names': self._names,
+                'current': self.current,
+                'index': self._index,
+                }
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as library_file:
+            json.dump(data, library_file)
+        os.rename(tmp_path, self._path)
+
+    def _load(self):
+        try:
+            with open(self._path, 'r') as library_file:
+                data = json.load(library_file)
+        except FileNotFoundError:
+            return
+
+        if data.get('version') != self._VERSION:
+            log.warning('%s: Unsupported version. Ignored.' % (self._path))
+            return
+        if data['backend'] != self._backend.name:
+            log.warning('%s: Built with %s fingerprint backend. Ignored.'
+                        % (self._path, data['backend']))
+            return
+
+        self._names = data['names']
+        self.current = data['current']
+        self._index = dict((code_hash, [tuple(entry) for entry in entries])
+                           for code_hash, entries in data['index'].items())
+
+    def histogram(self, names=None):
+        '''
+        Returns a new Histogram to match audio against the given samples (all
+        samples by default).
+        '''
+        if names is None:
+            names = self.names()
+        for name in names:
+            if name is None or name not in self._names:
+                raise self.NoSuchSampleError(name)
+        return SampleLibrary.Histogram(self, names)
+
+    def identify(self, code):
+        '''
+        Returns the list of (name, score, alignment) triplets ordered by
+        score, best first. The alignment is the position in the sample
+        [seconds] where the tested audio starts.
+        '''
+        histogram = self.histogram()
+        histogram.feed(Echonest.parse_code(code))
+        return histogram.results()
+
+    class Histogram:
+        def __init__(self, library, names):
+            self._library = library
+            self._ids = set(library._names.index(name) for name in names)
+            self._counts = collections.Counter()
+            self.total = 0
+
+        def feed(self, pairs, shift=0):
+            '''
+            Add tested (hash, offset) pairs. 'shift' is added to the offsets.
+            '''
+            index = self._library._index
+            for code_hash, offset in pairs:
+                for sample_id, sample_offset in index.get(code_hash, ()):
+                    if sample_id in self._ids:
+                        delta = sample_offset - (offset + shift)
+                        self._counts[(sample_id,
+                                      delta // SampleLibrary._BIN)] += 1
+            self.total += len(pairs)
+
+        def results(self):
+            peaks = dict((sample_id, (0, 0)) for sample_id in self._ids)
+            for (sample_id, delta_bin), count in self._counts.items():
+                count += self._counts.get((sample_id, delta_bin + 1), 0)
+                if count > peaks[sample_id][0]:
+                    peaks[sample_id] = (count, delta_bin)
+
+            unit = self._library._backend.offset_unit
+            results = []
+            for sample_id, (count, delta_bin) in peaks.items():
+                score = count / self.total if self.total else 0
+                alignment = (delta_bin + 1) * SampleLibrary._BIN * unit
+                results.append((self._library._names[sample_id], score,
+                                alignment))
+            results.sort(key=lambda result: result[1], reverse=True)
+            return results
+
+        def matches(self, name, threshold=None):
+            if threshold is None:
+                threshold = self._library._backend.threshold
+            for result_name, score, alignment in self.results():
+                if result_name == name:
+                    log.info('Matched %d%% samples at %.2fs. Threshold %d%%.'
+                             % (score * 100, alignment, threshold * 100))
+                    return score >= threshold
+            raise SampleLibrary.NoSuchSampleError(name)
+
+def verify_job(library_path, file_path, name):
+    '''
+    Process pool worker matching the recording at 'file_path' against the
+    named sample of the SampleLibrary at 'library_path'. The recording is
+    removed afterwards.
+
+    Returns (matches, error), with error being a message or an empty string.
+    Exceptions are not passed back as they may not be picklable.
+    '''
+    try:
+        # Daemonic pool workers cannot have their own pool
+        with Echonest.Segmenter(workers=1) as segmenter:
+            code = segmenter.merge(segmenter.codegen(file_path))
+        histogram = SampleLibrary(library_path).histogram([name])
+        histogram.feed(Echonest.parse_code(code))
+        return histogram.matches(name), ''
+    except Exception as e:
+        return False, str(e) or e.__class__.__name__
+    finally:
+        os.remove(file_path)
+
+class SampleCache:
+    '''
+    Content addressed store of audio samples with their fingerprint codes and
+    durations.
+
+    Each sample is stored under the SHA-256 digest of its content:
+
+        <path>/<digest>/audio
+        <path>/<digest>/duration
+        <path>/<digest>/code.<backend>
+
+    Fingerprint codes are computed on first use with each backend. The total
+    size is kept under 'max_size' bytes by evicting the least recently used
+    samples.
+    '''
+
+    class Error(Exception):
+        _dbus_error_name = 'org.merproject.btts.SampleCache.Error'
+
+    class InvalidDigestError(Error):
+        def __init__(self, digest):
+            SampleCache.Error.__init__(self, '%s: Not a valid SHA-256 digest'
+                                             % (digest))
+            self.digest = digest
+
+    class DigestMismatchError(Error):
+        def __init__(self, expected, actual):
+            SampleCache.Error.__init__(self, ('Sample digest mismatch: '
+                                              'expected %s, got %s')
+                                             % (expected, actual))
+
+    class NotCachedError(Error):
+        def __init__(self, digest):
+            SampleCache.Error.__init__(self, '%s: Sample not cached' % (digest))
+            self.digest = digest
+
+    class _HashingWriter:
+        def __init__(self, ofile):
+            self._ofile = ofile
+            self.hash = hashlib.sha256()
+
+        def write(self, b):
+            self.hash.update(b)
+            self._ofile.write(b)
+
+    def __init__(self, path, max_size):
+        self._path = path
+        self._max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def is_valid_digest(digest):
+        return re.match(r'^[0-9a-f]{64}$', digest) is not None
+
+    def contains(self, digest):
+        if not self.is_valid_digest(digest):
+            raise self.InvalidDigestError(digest)
+        return os.path.isdir(self._entry_path(digest))
+
+    def store(self, ifile, max_size, digest=None):
+        '''
+        Store sample read from 'ifile', at most 'max_size' bytes. If 'digest'
+        is given, the content must match it.
+
+        Returns the digest of the sample.
+        '''
+        if digest is not None and not self.is_valid_digest(digest):
+            raise self.InvalidDigestError(digest)
+
+        tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=self._path)
+        try:
+            with open(os.path.join(tmp_path, 'audio'), 'wb') as audio_file:
+                writer = SampleCache._HashingWriter(audio_file)
+                btts.utils.sendfile(writer, ifile, max_size)
+            actual_digest = writer.hash.hexdigest()
+            if digest is not None and actual_digest != digest:
+                raise self.DigestMismatchError(digest, actual_digest)
+
+            try:
+                duration = _exact_duration(os.path.join(tmp_path, 'audio'))
+            except subprocess.CalledProcessError:
+                log.warning('%s: Failed to determine sample duration'
+                            % (actual_digest))
+            else:
+                with open(os.path.join(tmp_path, 'duration'), 'w') \
+                        as duration_file:
+                    duration_file.write('%f\n' % (duration))
+
+            try:
+                os.rename(tmp_path, self._entry_path(actual_digest))
+            except OSError:
+                # Stored meanwhile
+                if not self.contains(actual_digest):
+                    raise
+        finally:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+
+        self._touch(actual_digest)
+        self._evict(keep=actual_digest)
 
+        return actual_digest
+
+    def audio_path(self, digest):
+        self._ensure_contains(digest)
+        self._touch(digest)
+        return os.path.join(self._entry_path(digest), 'audio')
+
+    def duration(self, digest):
+        '''
+        Returns the sample duration [secs] or None if unknown.
+        '''
+        self._ensure_contains(digest)
+        try:
+            with open(os.path.join(self._entry_path(digest), 'duration'),
+                      'r') as duration_file:
+                return float(duration_file.read())
+        except FileNotFoundError:
+            return None
+
+    def code(self, digest):
+        '''
+        Returns the fingerprint code computed with the current
+        btts.Echonest backend.
+        '''
+        audio_path = self.audio_path(digest)
+        code_path = os.path.join(self._entry_path(digest),
+                                 'code.' + Echonest.backend().name)
+        try:
+            with open(code_path, 'r') as code_file:
+                return code_file.read()
+        except FileNotFoundError:
+            pass
+
+        code = Echonest.codegen(audio_path)
+        with open(code_path + '.tmp', 'w') as code_file:
+            code_file.write(code)
+        os.rename(code_path + '.tmp', code_path)
         return code
 
+    def _entry_path(self, digest):
+        return os.path.join(self._path, digest)
+
+    def _ensure_contains(self, digest):
+        if not self.contains(digest):
+            raise self.NotCachedError(digest)
+
+    def _touch(self, digest):
+        os.utime(self._entry_path(digest), None)
+
+    def _entry_size(self, entry_path):
+        return sum(os.path.getsize(os.path.join(entry_path, name))
+                   for name in os.listdir(entry_path))
+
+    def _evict(self, keep):
+        entries = []
+        total_size = 0
+        for digest in os.listdir(self._path):
+            if not self.is_valid_digest(digest):
+                continue
+            entry_path = self._entry_path(digest)
+            size = self._entry_size(entry_path)
+            entries.append((os.path.getmtime(entry_path), digest, size))
+            total_size += size
+
+        entries.sort()
+        for mtime, digest, size in entries:
+            if total_size <= self._max_size:
+                break
+            if digest == keep:
+                continue
+            log.info('%s: Evicting sample from cache' % (digest))
+            shutil.rmtree(self._entry_path(digest))
+            total_size -= size
+
+def read_wav(file_path):
+    '''
+    Returns the PCM data, sample rate and number of channels of a 16 bit WAV
+    file.
+    '''
+    wav = wave.open(file_path, 'rb')
+    try:
+        if wav.getsampwidth() != 2:
+            raise ValueError('%s: Not a 16 bit WAV file' % (file_path))
+        return (wav.readframes(wav.getnframes()), wav.getframerate(),
+                wav.getnchannels())
+    finally:
+        wav.close()
+
+def write_wav(file_path, data, rate, channels=1):
+    wav = wave.open(file_path, 'wb')
+    try:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(data)
+    finally:
+        wav.close()
+
 class Minimodem:
+    '''
+    Binary FSK modem compatible with the minimodem tool.
+
+    Works in-process on signed 16 bit little endian PCM data. Characters are
+    sent with 8-N-1 framing, least significant bit first. Mark and space
+    frequencies are chosen the way minimodem does for the given baud rate -
+    Bell 202 like for 400 baud and more, Bell 103 like otherwise.
+    '''
+
     _BAUDMODE = '2'
-    _REASONABLE_TIMEOUT = 10
+    _RATE = 48000 # Hz; minimodem default
+    _AMPLITUDE = 0.5
+    _LEADER_BITS = 2
+    _TRAILER_BITS = 2
+
+    # Modulated signal by (message, baud, rate)
+    _cache = {}
+
+    @staticmethod
+    def _frequencies(baud):
+        '''
+        Returns (mark, space) frequencies [Hz]
+        '''
+        if baud >= 400:
+            mark = baud / 2 + 600
+            return mark, mark + baud * 5 / 6
+        else:
+            return 1270, 1070
+
+    @staticmethod
+    def modulate(message, baud=None, rate=_RATE):
+        '''
+        Returns the modulated message as PCM data (mono).
+        '''
+        baud = float(baud or Minimodem._BAUDMODE)
+        key = (message, baud, rate)
+        if key in Minimodem._cache:
+            return Minimodem._cache[key]
+
+        encoder = Minimodem.Encoder(baud, rate)
+        data = encoder.feed(message.encode('utf-8')) + encoder.finish()
+        Minimodem._cache[key] = data
+        return data
+
+    class Encoder:
+        '''
+        Incremental modulator - feed data in chunks of any size, the result
+        is the same as when modulated at once.
+        '''
+
+        def __init__(self, baud=None, rate=None):
+            import numpy as np
+            self._np = np
+
+            baud = float(baud or Minimodem._BAUDMODE)
+            rate = rate or Minimodem._RATE
+            self._rate = rate
+            self._mark, self._space = Minimodem._frequencies(baud)
+            self._bit_len = rate / baud
+            self._bits_sent = 0
+            self._samples_sent = 0
+            self._phase = 0.0
+            self._leader_sent = False
+
+        def feed(self, data):
+            '''
+            Returns the PCM data modulating the given bytes
+            '''
+            bits = []
+            if not self._leader_sent:
+                bits += [1] * Minimodem._LEADER_BITS
+                self._leader_sent = True
+            for byte in bytearray(data):
+                bits += [0] + [(byte >> i) & 1 for i in range(8)] + [1]
+            return self._modulate(bits)
+
+        def finish(self):
+            '''
+            Returns the PCM data ending the transmission
+            '''
+            return self._modulate([1] * Minimodem._TRAILER_BITS)
+
+        def _modulate(self, bits):
+            np = self._np
+
+            bits = np.array(bits)
+            end = int(round((self._bits_sent + len(bits)) * self._bit_len))
+            sample_bits = ((np.arange(self._samples_sent, end) / self._bit_len)
+                           .astype(int) - self._bits_sent)
+            frequency = np.where(bits[sample_bits] == 1, self._mark,
+                                 self._space)
+            # Continuous phase
+            phase = self._phase + 2 * np.pi * np.cumsum(frequency) / self._rate
+            if len(phase) > 0:
+                self._phase = phase[-1]
+            self._bits_sent += len(bits)
+            self._samples_sent = end
+
+            signal = np.sin(phase) * Minimodem._AMPLITUDE * 32767
+            return signal.astype('<i2').tobytes()
 
     @staticmethod
     def write(message, file_path):
-        cmd = ['minimodem', '--tx', '--file', file_path, Minimodem._BAUDMODE]
-        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
-                                universal_newlines=True)
-        proc.communicate(input=message, timeout=Minimodem._REASONABLE_TIMEOUT)
+        write_wav(file_path, Minimodem.modulate(message), Minimodem._RATE)
 
     @staticmethod
     def read(file_path):
-        cmd = ['minimodem', '--rx', '--file', file_path, Minimodem._BAUDMODE]
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                universal_newlines=True)
-        outs, errs = proc.communicate(timeout=Minimodem._REASONABLE_TIMEOUT)
-        return outs
+        data, rate, channels = read_wav(file_path)
+        decoder = Minimodem.Decoder(rate, channels)
+        decoder.feed(data)
+        return decoder.text
+
+    class Decoder:
+        '''
+        Incremental demodulator - feed PCM data as it comes, the text decoded
+        so far is available as 'text'.
+
+        Non-coherent detection: the signal is correlated with both the mark
+        and the space tone over a sliding window one bit long. Characters are
+        sampled at the bit centres following a mark to space transition and
+        only accepted when each bit is detected confidently and the framing
+        is correct.
+        '''
+
+        _CONFIDENCE = 0.5 # minimum |mark - space| / (mark + space)
+        _STEPS_PER_BIT = 16
+
+        def __init__(self, rate, channels=1, baud=None):
+            import numpy as np
+            self._np = np
+
+            baud = float(baud or Minimodem._BAUDMODE)
+            self._rate = rate
+            self._channels = channels
+            self._mark, self._space = Minimodem._frequencies(baud)
+            self._bit_len = rate / baud
+            self._window = int(self._bit_len)
+            self._half = self._window // 2
+            self._step = max(1, int(self._bit_len / self._STEPS_PER_BIT))
+
+            # Samples from absolute index _samples_base on
+            self._samples = np.zeros(0)
+            self._samples_base = 0
+            # Discriminator at positions k * _step, from k == _disc_base on
+            self._disc = np.zeros(0)
+            self._disc_base = -(-self._half // self._step)
+            self._search = self._disc_base + 1
+            self._bytes = bytearray()
+
+        @property
+        def text(self):
+            return self._bytes.decode('utf-8', 'replace')
+
+        def drain(self):
+            '''
+            Returns the bytes decoded since the last call and forgets them -
+            for long transmissions.
+            '''
+            data, self._bytes = bytes(self._bytes), bytearray()
+            return data
+
+        def feed(self, data):
+            np = self._np
+
+            samples = np.frombuffer(data, dtype='<i2')
+            samples = samples[:len(samples) - len(samples) % self._channels]
+            samples = samples.reshape(-1, self._channels).mean(axis=1) / 32768
+            self._samples = np.concatenate((self._samples, samples))
+
+            self._update_discriminator()
+            self._decode()
+
+            return self.text
+
+        def _update_discriminator(self):
+            np = self._np
+
+            first = self._disc_base + len(self._disc)
+            end = self._samples_base + len(self._samples)
+            last = (end - self._window + self._half) // self._step
+            if last < first:
+                return
+
+            positions = np.arange(first, last + 1) * self._step
+            starts = positions - self._half - self._samples_base
+            n = self._samples_base + np.arange(len(self._samples))
+
+            power = []
+            for frequency in (self._mark, self._space):
+                mixed = self._samples * np.exp(-2j * np.pi * frequency * n
+                                               / self._rate)
+                sums = np.concatenate(([0], np.cumsum(mixed)))
+                power.append(np.abs(sums[starts + self._window]
+                                    - sums[starts]) ** 2)
+            mark, space = power
+            disc = (mark - space) / (mark + space + 1e-12)
+            self._disc = np.concatenate((self._disc, disc))
+
+            # Only what the next discriminator values need is kept
+            keep_from = (last + 1) * self._step - self._half
+            self._samples = self._samples[keep_from - self._samples_base:]
+            self._samples_base = keep_from
+
+        def _decode(self):
+            np = self._np
+
+            disc_end = self._disc_base + len(self._disc)
+            offsets = (np.arange(10) + 0.5) * self._bit_len
+
+            while True:
+                # Find mark to space transition
+                seg = self._disc[self._search - 1 - self._disc_base:]
+                edges = np.flatnonzero((seg[:-1] > 0) & (seg[1:] <= 0))
+                if len(edges) == 0:
+                    self._search = max(self._search, disc_end - 1)
+                    break
+                edge = self._search + edges[0]
+
+                centres = np.round((edge * self._step + offsets)
+                                   / self._step).astype(int)
+                if centres[-1] >= disc_end:
+                    self._search = edge
+                    break
+
+                values = self._disc[centres - self._disc_base]
+                if (np.all(np.abs(values) > self._CONFIDENCE)
+                        and values[0] < 0 and values[9] > 0):
+                    bits = (values[1:9] > 0).astype(int)
+                    self._bytes.append(int(np.sum(bits << np.arange(8))))
+                    self._search = centres[9]
+                else:
+                    self._search = edge + 1
+
+            # Drop what is not needed any more
+            drop = self._search - 1 - self._disc_base
+            if drop > 0:
+                self._disc = self._disc[drop:]
+                self._disc_base += drop
+
+    class ErrorCounter:
+        '''
+        Compares the bytes received with those expected, as they come, with
+        memory use bounded.
+
+        Bytes lost or inserted (a start bit missed or a false one detected)
+        are told from corrupted ones by looking for _SYNC consecutive matching
+        bytes with up to _MAX_SHIFT bytes lost or inserted. Bit errors are
+        only counted in the bytes paired this way.
+
+        Statistics are also collected per 'segment' expected bytes, so that
+        clusters of errors can be located.
+        '''
+
+        _SYNC = 4 # bytes
+        _MAX_SHIFT = 16 # bytes
+
+        # Statistics fields
+        COMPARED, BIT_ERRORS, LOST, INSERTED = range(4)
+
+        def __init__(self, expected, segment):
+            '''
+            'expected' is an iterator of the expected byte values.
+            '''
+            self._expected_iter = iter(expected)
+            self._expected = collections.deque()
+            self._expected_done = False
+            self._received = collections.deque()
+            self._segment = segment
+
+            self.position = 0 # of the next expected byte
+            # Bytes compared, bit errors, bytes lost and bytes inserted -
+            # indexed by the statistics fields
+            self.totals = [0] * 4
+            # The same by segment
+            self.segments = collections.OrderedDict()
+
+        @property
+        def complete(self):
+            '''
+            True when no more bytes are expected
+            '''
+            self._fill(1)
+            return not self._expected
+
+        def feed(self, data):
+            self._received.extend(bytearray(data))
+            lookahead = self._SYNC + self._MAX_SHIFT
+            while len(self._received) >= lookahead:
+                if not self._step(lookahead):
+                    break
+
+        def finish(self):
+            '''
+            Compare what is left. Bytes never received count as lost.
+            '''
+            while self._received:
+                if not self._step(self._SYNC + self._MAX_SHIFT):
+                    break
+            self._count(self.LOST, len(self._received))
+            self._received.clear()
+            while self._fill(1):
+                self._count(self.LOST, 1)
+                self._expected.popleft()
+                self.position += 1
+
+        def _fill(self, count):
+            while len(self._expected) < count and not self._expected_done:
+                try:
+                    self._expected.append(next(self._expected_iter))
+                except StopIteration:
+                    self._expected_done = True
+            return len(self._expected) >= count
+
+        def _step(self, lookahead):
+            self._fill(lookahead)
+            if not self._expected:
+                # Everything expected seen, the rest is inserted
+                self._count(self.INSERTED, len(self._received))
+                self._received.clear()
+                return False
+
+            if self._received[0] != self._expected[0]:
+                shift = self._resync()
+                if shift > 0:
+                    for i in range(shift):
+                        self._expected.popleft()
+                    self._count(self.LOST, shift)
+                    self.position += shift
+                    return True
+                if shift < 0:
+                    for i in range(-shift):
+                        self._received.popleft()
+                    self._count(self.INSERTED, -shift)
+                    return True
+
+            received = self._received.popleft()
+            expected = self._expected.popleft()
+            self._count(self.COMPARED, 1)
+            self._count(self.BIT_ERRORS, bin(received ^ expected).count('1'))
+            self.position += 1
+            return True
+
+        def _resync(self):
+            '''
+            Returns the number of bytes lost (positive) or inserted
+            (negative) to get in sync again, zero for a corrupted byte.
+            '''
+            lookahead = self._SYNC + self._MAX_SHIFT
+            received = list(itertools.islice(self._received, lookahead))
+            expected = list(itertools.islice(self._expected, lookahead))
+            sync = self._SYNC
+
+            def matches(r, e):
+                return (len(received) >= r + sync and len(expected) >= e + sync
+                        and received[r:r + sync] == expected[e:e + sync])
+
+            if matches(1, 1):
+                return 0
+            for shift in range(1, self._MAX_SHIFT + 1):
+                if matches(0, shift):
+                    return shift
+                if matches(shift, 0):
+                    return -shift
+            return 0
+
+        def _count(self, field, value):
+            if value == 0:
+                return
+            self.totals[field] += value
+            segment = self.position // self._segment
+            counts = self.segments.setdefault(segment, [0, 0, 0, 0])
+            counts[field] += value
 
 class Recorder:
+    '''
+    Records audio received from the device.
+
+    Recording is done by a backend selected with the BTTS_RECORDER_BACKEND
+    environment variable:
+
+        capture  - in-process PulseAudio client, see btts.pulse (default)
+        pipeline - parec and sox subprocesses
+
+    The capture backend falls back to the pipeline when it fails to connect.
+    Only the capture backend collects complete timing, see timing(). Gaps in
+    the received audio are reported when they are at least as long as set
+    with the BTTS_RECORDER_GAP_THRESHOLD environment variable (seconds).
+    '''
+
+    _DEFAULT_BACKEND = 'capture'
+    _DEFAULT_GAP_THRESHOLD = 0.1 # seconds
+    # Leading silence is skipped, see btts.pulse.Capture
+    _GATE_DURATION = 0.5 # seconds
+    _GATE_THRESHOLD = 0.001
+    _RATE = 44100 # Hz
+
     class Error(Exception):
         _dbus_error_name = 'org.merproject.btts.Recorder.Error'
 
@@ -104,6 +1146,11 @@ class Recorder:
         def __init__(self):
             Recorder.Error.__init__(self, 'Operation not started')
 
+    class NoSuchBackendError(Error):
+        def __init__(self, backend):
+            Recorder.Error.__init__(self, '%s: No such recorder backend'
+                                          % (backend))
+
     class RecordTooShortError(Error):
         def __init__(self, actual_duration, expected_duration):
             Recorder.Error.__init__(self, ('The duration of the recorded '
@@ -111,9 +1158,85 @@ class Recorder:
                                            'expected (%dsecs)')
                                           % (actual_duration, expected_duration))
 
+    class _Writer(threading.Thread):
+        '''
+        Drains the capture ring buffer into the output file and, optionally,
+        window files named the way sox names them with 'newfile'.
+        '''
+
+        def __init__(self, capture, ofile, window, finished_fd):
+            threading.Thread.__init__(self, name='btts-recorder-writer')
+            self.daemon = True
+
+            self.frames = 0
+            # Completed windows as (path, duration) pairs
+            self.windows = []
+
+            self._capture = capture
+            self._reader = capture.ring.reader()
+            self._ofile = ofile
+            self._window_frames = int(window * capture.rate)
+            self._window_file = None
+            self._finished_fd = finished_fd
+
+        def run(self):
+            out = self._open(self._ofile)
+            try:
+                while not self._reader.at_end:
+                    self._reader.wait()
+                    for view in self._reader.read():
+                        out.writeframesraw(view)
+                        self.frames += len(view) // self._capture.frame_size
+                        if self._window_frames > 0:
+                            self._write_windows(view)
+            except btts.pulse.RingBuffer.OverrunError as e:
+                log.warning('%s: %s' % (self._ofile, e))
+            finally:
+                out.close()
+                if self._window_file is not None:
+                    self._close_window()
+                os.close(self._finished_fd)
+
+        def _open(self, path):
+            wav = wave.open(path, 'wb')
+            wav.setnchannels(self._capture.channels)
+            wav.setsampwidth(2)
+            wav.setframerate(self._capture.rate)
+            return wav
+
+        def _write_windows(self, view):
+            frame_size = self._capture.frame_size
+            while len(view) > 0:
+                if self._window_file is None:
+                    base, ext = os.path.splitext(
+                            Recorder._window_path(self._ofile))
+                    self._window_file_path = ('%s%03d%s'
+                                              % (base, len(self.windows) + 1,
+                                                 ext))
+                    self._window_file = self._open(self._window_file_path)
+                    self._window_file_frames = 0
+
+                frames = min(len(view) // frame_size,
+                             self._window_frames - self._window_file_frames)
+                self._window_file.writeframesraw(view[:frames * frame_size])
+                self._window_file_frames += frames
+                view = view[frames * frame_size:]
+
+                if self._window_file_frames == self._window_frames:
+                    self._close_window()
+
+        def _close_window(self):
+            self._window_file.close()
+            self._window_file = None
+            self.windows.append((self._window_file_path,
+                                 self._window_file_frames / self._capture.rate))
+
     def __init__(self):
-        self._parec = None
-        self._sox = None
+        self._pipeline = None
+        self._capture = None
+        self._finished_fd = None
+        self._window = 0
+        self._timing_start = None
 
     def _ensure_ready(self):
         config = btts.Config()
@@ -126,45 +1249,132 @@ class Recorder:
         config = btts.Config()
         return config.device.upper().replace(':', '_')
 
+    @staticmethod
+    def _tracker():
+        try:
+            return btts.pulse.Tracker.instance()
+        except btts.pulse.Tracker.Error as e:
+            raise Recorder.Error(str(e))
+
     @staticmethod
     def receiving_audio():
-        args = ('''pactl list short sources |awk '$2 == "bluez_source.%s" { print $7 }' '''
-                % (Recorder._device_address_for_pa()))
-        out = subprocess.check_output(args, shell=True, universal_newlines=True)
-        return out.strip() == 'RUNNING'
+        tracker = Recorder._tracker()
+        source = 'bluez_source.%s' % (Recorder._device_address_for_pa())
+        return tracker.source_state(source) == 'RUNNING'
+
+    @staticmethod
+    def expect_receiving_audio(receiving=True, timeout=None):
+        '''
+        Wait until receiving audio starts (or stops if 'receiving' is False).
+
+        Returns False on timeout.
+        '''
+        tracker = Recorder._tracker()
+        source = 'bluez_source.%s' % (Recorder._device_address_for_pa())
+        return tracker.wait_for(lambda: ((tracker.source_state(source)
+                                          == 'RUNNING') == receiving),
+                                timeout)
 
-    def start(self, ofile, profile, duration = 0, start_padding=0, mono=False):
+    def start(self, ofile, profile, duration = 0, start_padding=0, mono=False,
+              window=0):
+        '''
+        Start recording.
+
+        If 'window' (seconds) is given, the recording is additionally made
+        available in consecutive windows of that length as it progresses. See
+        windows().
+        '''
         assert profile in _pa_profile_by_bt_profile.keys()
         assert duration >= 0
+        assert window >= 0
 
         self._ensure_ready()
 
-        if self._sox != None:
+        backend = os.environ.get('BTTS_RECORDER_BACKEND',
+                                 self._DEFAULT_BACKEND)
+        if backend not in ('capture', 'pipeline'):
+            raise self.NoSuchBackendError(backend)
+
+        if self.recording:
             log.info('Recording in progress. Restarting!')
-            self._parec.terminate()
             try:
-                self._sox.wait(timeout=_REASONABLE_TERMINATE_TIME)
-                self._parec.wait(timeout=_REASONABLE_TERMINATE_TIME)
-            except subprocess.TimeoutExpired:
-                log.warning('Recording pipeline refused to terminate. Will be killed.')
-                self._sox.kill()
-                self._parec.kill()
-            finally:
-                self._sox = None
-                self._parec = None
+                self._terminate()
+            except btts.cliutils.Failure:
+                log.warning('Recording pipeline refused to terminate. Killed.')
+
+        timing_start = time.monotonic()
 
         pa_profile = _pa_profile_by_bt_profile[profile]
 
-        # Card profile must be switched before parec is started, otherwise it
-        # would get reconnected to default source upon playback-started profile
-        # change.
-        set_card_profile_cmd = ('pactl set-card-profile bluez_card.%s %s'
-                                % (self._device_address_for_pa(), pa_profile)).split()
+        # Card profile must be switched before recording is started, otherwise
+        # it would get reconnected to default source upon playback-started
+        # profile change.
+        card = 'bluez_card.%s' % (self._device_address_for_pa())
+        source = 'bluez_source.%s' % (self._device_address_for_pa())
+        tracker = self._tracker()
+        initial_timing = [
+                (timing_start, 'source', tracker.source_state(source)),
+                (timing_start, 'card', tracker.card_profile(card)),
+                ]
+        try:
+            tracker.set_card_profile(card, pa_profile)
+        except btts.pulse.Tracker.Error as e:
+            raise self.Error('Failed to set card profile: %s' % (e))
+
+        for stale in self._window_paths(ofile):
+            os.remove(stale)
+
+        self._timing_start = timing_start
+        self._initial_timing = initial_timing
+        self._capture_timing = []
+
+        # Reaches end of file once the recording finishes, see finished_fd()
+        self._finished_fd, finished_wfd = os.pipe()
+        if (backend != 'capture'
+                or not self._start_capture(ofile, duration, mono, window,
+                                           finished_wfd)):
+            self._start_pipeline(ofile, duration, mono, window, finished_wfd)
+
+        self._start_time = time.monotonic()
+        self._duration = duration
+        self._start_padding = start_padding
+        self._window = window
+        self._windows_taken = 0
+        self._windows_read = 0
+
+        self._ofile = ofile
+
+    def _start_capture(self, ofile, duration, mono, window, finished_fd):
+        '''
+        Returns False if the capture could not be started. Otherwise takes
+        ownership of 'finished_fd'.
+        '''
+        capture = btts.pulse.Capture('bluez_source.%s'
+                                     % (self._device_address_for_pa()),
+                                     rate=self._RATE,
+                                     channels=1 if mono else 2,
+                                     duration=duration,
+                                     gate_duration=self._GATE_DURATION,
+                                     gate_threshold=self._GATE_THRESHOLD,
+                                     gap_threshold=float(os.environ.get(
+                                         'BTTS_RECORDER_GAP_THRESHOLD',
+                                         self._DEFAULT_GAP_THRESHOLD)))
         try:
-            subprocess.check_call(set_card_profile_cmd)
-        except subprocess.CalledProcessError as e:
-            raise self.Error('Failed to set card profile: pactl failed')
+            capture.start()
+        except btts.pulse.Capture.Error as e:
+            log.warning('%s. Falling back to recording pipeline' % (e))
+            return False
+
+        self._capture = capture
+        # Stays available after the capture is released
+        self._capture_timing = capture.timing
+        self._reader = capture.ring.reader()
+        self._writer = Recorder._Writer(capture, ofile, window, finished_fd)
+        self._writer.start()
 
+        return True
+
+    def _start_pipeline(self, ofile, duration, mono, window, finished_fd):
         # Notes:
         # 1. Not using `sox -t pulseaudio <pa_dev>` as SoX uses pa_simple which
         # connects streams with PA_STREAM_INTERPOLATE_TIMING.
@@ -172,53 +1382,680 @@ class Recorder:
         # http://www.mega-nerd.com/libsndfile/FAQ.html#Q017
         parec_cmd = ('parec --device bluez_source.%s --file-format=au'
                      % (self._device_address_for_pa())).split()
-        sox_cmd = ('sox -q -t au - %s silence 1 0.5 0.1%%'
-                   % (ofile)).split()
+        if window > 0:
+            # The second sox splits the output in windows, each of them
+            # closed (i.e. complete) before the next one is opened
+            sox_cmd = 'sox -q -t au - -t au -'.split()
+            split_cmd = ('sox -q -t au - %s trim 0 %d : newfile : restart'
+                         % (self._window_path(ofile), window)).split()
+        else:
+            sox_cmd = ('sox -q -t au - %s' % (ofile)).split()
+        sox_cmd += ('silence 1 %g %g%%' % (self._GATE_DURATION,
+                                           self._GATE_THRESHOLD * 100)).split()
         if duration > 0:
             sox_cmd += ('trim 0 %d' % (duration)).split()
         if mono:
             sox_cmd += ('remix -').split()
 
-        self._parec = subprocess.Popen(parec_cmd, stdout=subprocess.PIPE)
-        self._sox = subprocess.Popen(sox_cmd, stdin=self._parec.stdout)
-        self._parec.stdout.close()
+        # The last process holds 'finished_fd' open until it exits
+        try:
+            parec = subprocess.Popen(parec_cmd, stdout=subprocess.PIPE)
+            self._pipeline = [parec]
+            if window > 0:
+                sox = subprocess.Popen(sox_cmd, stdin=parec.stdout,
+                                       stdout=subprocess.PIPE)
+                split = subprocess.Popen(split_cmd, stdin=sox.stdout,
+                                         pass_fds=(finished_fd,))
+                sox.stdout.close()
+                self._pipeline += [sox, split]
+            else:
+                sox = subprocess.Popen(sox_cmd, stdin=parec.stdout,
+                                       pass_fds=(finished_fd,))
+                self._pipeline += [sox]
+            parec.stdout.close()
+        finally:
+            os.close(finished_fd)
 
-        self._start_time = time.monotonic()
-        self._duration = duration
-        self._start_padding = start_padding
+    def windows(self):
+        '''
+        Returns the list of (path, duration) pairs for the windows completed
+        since the last call and a boolean indicating whether the recording
+        has finished.
 
-        self._ofile = ofile
+        Only available when started with non zero 'window'.
+        '''
+        if self._window == 0:
+            raise self.NotStartedError()
+
+        completed, finished = self._completed_windows()
+        new = completed[self._windows_taken:]
+        self._windows_taken = len(completed)
+
+        if self._capture != None:
+            return new, finished
+        return [(path, _exact_duration(path)) for path in new], finished
+
+    def read(self):
+        '''
+        Returns the list of (data, rate, channels) triples with the PCM data
+        (signed 16 bit little endian) recorded since the last call and a
+        boolean indicating whether the recording has finished.
+
+        With the capture backend the data are memoryviews of its ring buffer,
+        to be consumed before the next call. With the pipeline backend the
+        data come from the windows and so this is only available when started
+        with non zero 'window'.
+        '''
+        if self._capture != None:
+            capture = self._capture
+            finished = self._reader.at_end
+            chunks = [(view, capture.rate, capture.channels)
+                      for view in self._reader.read()]
+            return chunks, finished
+
+        if self._window == 0:
+            raise self.NotStartedError()
+
+        completed, finished = self._completed_windows()
+        new = completed[self._windows_read:]
+        self._windows_read = len(completed)
+
+        return [read_wav(path) for path in new], finished
+
+    def _completed_windows(self):
+        if self._capture != None:
+            return list(self._writer.windows), not self._writer.is_alive()
+
+        if self._pipeline == None:
+            raise self.NotStartedError()
+
+        finished = self._pipeline[-1].poll() != None
+
+        paths = self._window_paths(self._ofile)
+        # The last window is still being written until the recording finishes
+        completed = paths if finished else paths[:-1]
+
+        return completed, finished
+
+    def timing(self):
+        '''
+        Returns the list of (time, event, detail) triplets with the timing of
+        the current or last recording, ordered by time. Time is relative to
+        the call to start() [secs].
+
+        Events are those of btts.pulse.Capture and:
+
+            source <state> - the source state at start and its changes
+            card <profile> - the card profile at start and its changes
+
+        The state or profile is "none" when there is no such source or card.
+        '''
+        if self._timing_start is None:
+            raise self.NotStartedError()
+
+        source = 'bluez_source.%s' % (self._device_address_for_pa())
+        card = 'bluez_card.%s' % (self._device_address_for_pa())
+        tracker = self._tracker()
+
+        events = list(self._initial_timing)
+        for event, name in (('source', source), ('card', card)):
+            events += [(when, event, value)
+                       for when, value in tracker.transitions(
+                               name, self._timing_start)]
+        events += list(self._capture_timing)
+
+        # Sorting is stable, initial states stay first
+        events.sort(key=lambda event: event[0])
+        return [(when - self._timing_start, event,
+                 'none' if detail is None else detail)
+                for when, event, detail in events]
+
+    @property
+    def recording(self):
+        '''
+        True from start() until the recording is stopped or waited for
+        '''
+        return self._pipeline != None or self._capture != None
+
+    def finished_fd(self):
+        '''
+        Returns a file descriptor which reaches end of file once the recording
+        finishes - suitable for main loop IO watches. It stays valid until
+        the recording is stopped or waited for.
+        '''
+        if not self.recording:
+            raise self.NotStartedError()
+
+        return self._finished_fd
+
+    def wait_timeout(self):
+        '''
+        Returns the time (seconds) left for the recording to finish, as
+        waited by wait().
+        '''
+        if not self.recording:
+            raise self.NotStartedError()
+
+        elapsed = time.monotonic() - self._start_time
+        return max(0, self._duration - elapsed) + self._start_padding
+
+    def request_stop(self):
+        '''
+        Make the recording finish early without waiting for it. Use
+        finished_fd() to learn when it did, then stop() or finish().
+        '''
+        if not self.recording:
+            raise self.NotStartedError()
+
+        if self._capture != None:
+            self._capture.stop()
+        elif self._pipeline[-1].poll() == None:
+            self._pipeline[0].terminate()
+
+    def stop(self):
+        '''
+        Stop recording early. No minimum duration is enforced.
+        '''
+        if not self.recording:
+            raise self.NotStartedError()
+
+        self._finalize(self._terminate())
 
     def wait(self):
         self._ensure_ready()
 
-        if self._sox == None:
+        if not self.recording:
             raise self.NotStartedError()
 
-        elapsed = time.monotonic() - self._start_time
-        remaining = max(0, self._duration - elapsed)
-        remaining += self._start_padding
+        select.select([self._finished_fd], [], [], self.wait_timeout())
+
+        self.finish()
 
+    def finish(self):
+        '''
+        Complete the recording once it finished or wait_timeout() elapsed.
+        This is what wait() does after waiting - to be used when waiting with
+        finished_fd().
+        '''
+        if not self.recording:
+            raise self.NotStartedError()
+
+        duration = self._finalize(self._terminate())
+
+        if duration < self._duration:
+            raise self.RecordTooShortError(duration, self._duration)
+
+    def _terminate(self):
+        '''
+        Returns the duration recorded if known, otherwise None.
+        '''
         try:
-            self._sox.wait(timeout=remaining)
-        except subprocess.TimeoutExpired:
-            self._parec.terminate()
+            if self._capture != None:
+                return self._terminate_capture()
+            self._terminate_pipeline()
+            return None
+        finally:
+            os.close(self._finished_fd)
+            self._finished_fd = None
+
+    def _terminate_capture(self):
+        capture, self._capture = self._capture, None
+        capture.stop()
+
+        writer, self._writer = self._writer, None
+        writer.join(timeout=_REASONABLE_TERMINATE_TIME)
+        if writer.is_alive():
+            raise btts.cliutils.Failure('Recording writer refused to terminate')
+
+        if capture.error != None:
+            log.warning(capture.error)
+
+        return math.floor(writer.frames / capture.rate)
+
+    def _terminate_pipeline(self):
+        # Terminating the source makes the rest of the pipeline finish
+        pipeline, self._pipeline = self._pipeline, None
+        if pipeline[-1].poll() == None:
+            pipeline[0].terminate()
 
         try:
-            self._sox.wait(timeout=_REASONABLE_TERMINATE_TIME)
-            self._parec.wait(timeout=_REASONABLE_TERMINATE_TIME)
+            for proc in reversed(pipeline):
+                proc.wait(timeout=_REASONABLE_TERMINATE_TIME)
         except subprocess.TimeoutExpired:
-            self._sox.kill()
-            self._parec.kill()
+            for proc in pipeline:
+                proc.kill()
             raise btts.cliutils.Failure('Recording pipeline refused to terminate')
-        finally:
-            self._sox = None
-            self._parec = None
 
-        duration = _duration(self._ofile)
+    def _finalize(self, duration):
+        if duration != None:
+            # Written in-process, duration known from the sample count
+            return duration
+        if self._window > 0:
+            # Join the windows so the whole record is available as usual
+            paths = self._window_paths(self._ofile)
+            if not paths:
+                return 0
+            subprocess.check_call(['sox', '-q'] + paths + [self._ofile])
+        return _duration(self._ofile)
 
-        if duration < self._duration:
-            raise self.RecordTooShortError(duration, self._duration)
+    @staticmethod
+    def _window_path(ofile):
+        base, ext = os.path.splitext(ofile)
+        return base + '-window' + ext
+
+    @staticmethod
+    def _window_paths(ofile):
+        # sox appends a three digit sequence number with 'newfile'
+        base, ext = os.path.splitext(Recorder._window_path(ofile))
+        return sorted(glob.glob(base + '[0-9][0-9][0-9]' + ext))
+
+class Monitor:
+    '''
+    Long-running monitor of audio received from the device.
+
+    Audio is captured continuously into a ring buffer of fixed size (see
+    btts.pulse.Capture) and analysed as it arrives:
+
+        - RMS level of each second
+        - dropouts - runs of silence (measured in 20ms blocks) shorter than
+          _SILENCE_MIN, and silences - the longer ones, not counting the
+          silence before any audio is received
+        - restarts - the source started running again, and reconnects - the
+          capture stream failed and got reconnected
+        - matching against a sample (optional) - consecutive windows of
+          'window' seconds are matched one by one
+
+    Only compact statistics are kept: per-second levels of the last
+    'history' seconds, window scores and the last _MAX_EVENTS events. The
+    audio surrounding an event is dumped to 'dump_dir', keeping at most
+    _MAX_DUMPS files. Memory and disk use do not grow with the duration of
+    monitoring.
+
+    Times are seconds of audio received since start().
+    '''
+
+    _RATE = 44100 # Hz
+    _CAPACITY = 60 # seconds
+    _BLOCK = 0.02 # seconds
+    _SILENCE_THRESHOLD = 0.001 # relative to full scale
+    _DROPOUT_MIN = 0.04 # seconds
+    _SILENCE_MIN = 2 # seconds
+    _MIN_LEVEL = -120 # dBFS
+    _DUMP_BEFORE = 5 # seconds
+    _DUMP_AFTER = 5 # seconds
+    _MAX_DUMPS = 20
+    _MAX_EVENTS = 1000
+    _POLL_INTERVAL = 0.5 # seconds
+    _RECONNECT_INTERVAL = 1 # seconds
+
+    class Error(Exception):
+        _dbus_error_name = 'org.merproject.btts.Monitor.Error'
+
+    class Event:
+        dropout = 'dropout'
+        silence = 'silence'
+        restart = 'restart'
+        reconnect = 'reconnect'
+        mismatch = 'mismatch'
+
+    def __init__(self, profile, dump_dir, window=10, history=86400,
+                 library=None, sample=None):
+        assert profile in _pa_profile_by_bt_profile.keys()
+        assert(0 < window
+               <= self._CAPACITY - self._DUMP_BEFORE - self._DUMP_AFTER)
+
+        # Pulls in numpy - only when needed
+        import numpy as np
+        self._np = np
+
+        self._profile = profile
+        self._dump_dir = dump_dir
+        self._window = window
+        self._library = library
+        self._sample = sample
+
+        self._source = 'bluez_source.%s' % (Recorder._device_address_for_pa())
+        self._block_size = int(self._BLOCK * self._RATE) * 2
+        self._window_size = int(window * self._RATE) * 2
+
+        self._lock = threading.Lock()
+        self._levels = collections.deque(maxlen=history)
+        self._scores = collections.deque(maxlen=history // window + 1)
+        self._events = collections.deque(maxlen=self._MAX_EVENTS)
+        self._dumps = collections.deque()
+        self._counts = collections.Counter()
+
+        self._start_time = time.monotonic()
+        self._frames = 0
+        self._capture = None
+        self._thread = None
+        self._matcher = None
+        self._stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            raise self.Error('Already running')
+
+        config = btts.Config()
+        if not config.profile_enabled(self._profile):
+            raise self.Error('Profile not enabled: %s' % (self._profile))
+
+        card = 'bluez_card.%s' % (Recorder._device_address_for_pa())
+        try:
+            Recorder._tracker().set_card_profile(
+                    card, _pa_profile_by_bt_profile[self._profile])
+        except btts.pulse.Tracker.Error as e:
+            raise self.Error('Failed to set card profile: %s' % (e))
+
+        if not os.path.isdir(self._dump_dir):
+            os.makedirs(self._dump_dir)
+
+        self._start_time = time.monotonic()
+        self._frames = 0
+        self._pending = bytearray()
+        self._second_frames = 0
+        self._second_energy = 0.0
+        self._heard = False
+        self._silent_blocks = 0
+        self._window_data = bytearray()
+        self._window_start = 0
+        self._matched = False
+        self._running_source = None
+        self._dump_requests = []
+
+        # Failing to connect for the first time is an error, later it is a
+        # 'reconnect' event
+        self._connect_capture()
+
+        self._windows = queue.Queue(maxsize=1)
+        if self._sample is not None:
+            self._matcher = threading.Thread(target=self._match,
+                                             name='btts-monitor-matcher')
+            self._matcher.daemon = True
+            self._matcher.start()
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='btts-monitor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stop monitoring. The statistics stay available.
+        '''
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._matcher is not None:
+            # Make room for the end mark - the matcher may lag behind or be
+            # gone. Nothing else is queued after the capture thread ended.
+            try:
+                self._windows.get_nowait()
+            except queue.Empty:
+                pass
+            self._windows.put(None)
+            self._matcher.join()
+            self._matcher = None
+        if self._capture is not None:
+            self._capture.stop()
+            self._capture = None
+
+    def report(self):
+        '''
+        Returns (summary, events, seconds) where:
+
+            summary - dict of totals, see below
+            events  - list of (time, kind, duration) triplets, see Event
+            seconds - list of (time, level, score) triplets, where level is
+                      the RMS level [dBFS] and score the score of the
+                      window the second belongs to (-1 when not matched)
+
+        Summary items: elapsed (wall clock time since start), recorded
+        (seconds of audio received), silent (seconds of silence), windows,
+        matched (windows matched), skipped (windows not matched while
+        matching lagged behind), errors (windows failed to be matched),
+        overruns (audio lost while analysis lagged behind), dumps, and the
+        number of events of each kind.
+        '''
+        with self._lock:
+            summary = dict((name, 0) for name in (
+                    'silent', 'windows', 'matched', 'skipped', 'errors',
+                    'overruns',
+                    self.Event.dropout, self.Event.silence,
+                    self.Event.restart, self.Event.reconnect,
+                    self.Event.mismatch))
+            summary.update(self._counts)
+            summary['elapsed'] = time.monotonic() - self._start_time
+            summary['recorded'] = self._frames / self._RATE
+            summary['dumps'] = len(self._dumps)
+
+            events = list(self._events)
+
+            first_second = int(self._frames // self._RATE) - len(self._levels)
+            scores = dict()
+            for start, score in self._scores:
+                for second in range(int(start), int(start + self._window)):
+                    scores[second] = score
+            seconds = [(first_second + i, level,
+                        scores.get(first_second + i, -1))
+                       for i, level in enumerate(self._levels)]
+
+        return summary, events, seconds
+
+    def _connect_capture(self):
+        capture = btts.pulse.Capture(self._source, rate=self._RATE,
+                                     channels=1, capacity=self._CAPACITY)
+        try:
+            capture.start()
+        except btts.pulse.Capture.Error as e:
+            raise self.Error(str(e))
+        self._capture = capture
+        self._reader = capture.ring.reader()
+        # Time of the start of the ring buffer
+        self._capture_start = self._frames / self._RATE
+        self._pending = bytearray()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            if self._capture is None or self._capture.finished:
+                self._reconnect()
+                continue
+
+            self._reader.wait(self._POLL_INTERVAL)
+            try:
+                for view in self._reader.read():
+                    self._analyse(view)
+            except btts.pulse.RingBuffer.OverrunError as e:
+                log.warning('%s: %s' % (self._source, e))
+                with self._lock:
+                    self._counts['overruns'] += 1
+
+            self._check_source()
+            self._dump_pending()
+
+    def _reconnect(self):
+        if self._capture is not None:
+            log.warning('%s: Capture lost (%s). Reconnecting.'
+                        % (self._source, self._capture.error))
+            self._capture.stop()
+            self._capture = None
+            # Pending dumps refer to the lost ring buffer
+            with self._lock:
+                self._dump_requests = []
+        try:
+            self._connect_capture()
+        except Monitor.Error:
+            self._stopping.wait(self._RECONNECT_INTERVAL)
+            return
+        self._event(self.Event.reconnect, self._frames / self._RATE, 0)
+
+    def _check_source(self):
+        try:
+            running = (Recorder._tracker().source_state(self._source)
+                       == 'RUNNING')
+        except Recorder.Error as e:
+            log.warning('%s: %s' % (self._source, e))
+            return
+        if running and self._running_source is False:
+            self._event(self.Event.restart, self._frames / self._RATE, 0)
+        self._running_source = running
+
+    def _analyse(self, view):
+        np = self._np
+        self._pending += view
+        size = len(self._pending) - len(self._pending) % self._block_size
+        if size == 0:
+            return
+        blocks = np.frombuffer(bytes(self._pending[:size]), dtype='<i2')
+        blocks = blocks.reshape(-1, self._block_size // 2)
+        energies = np.sum(blocks.astype(np.float64) ** 2, axis=1)
+        block_frames = self._block_size // 2
+
+        for i, energy in enumerate(energies.tolist()):
+            rms = math.sqrt(energy / block_frames) / 32768
+            self._analyse_block(rms, block_frames)
+            self._collect_window(self._pending[i * self._block_size:
+                                               (i + 1) * self._block_size])
+            self._frames += block_frames
+            self._second_energy += energy
+            self._second_frames += block_frames
+            if self._second_frames >= self._RATE:
+                self._close_second()
+
+        del self._pending[:size]
+
+    def _analyse_block(self, rms, block_frames):
+        if rms >= self._SILENCE_THRESHOLD:
+            self._heard = True
+            self._end_silence()
+        elif self._heard:
+            self._silent_blocks += 1
+            with self._lock:
+                self._counts['silent'] += block_frames / self._RATE
+
+    def _end_silence(self):
+        duration = self._silent_blocks * self._BLOCK
+        self._silent_blocks = 0
+        if duration < self._DROPOUT_MIN:
+            return
+        kind = (self.Event.silence if duration >= self._SILENCE_MIN
+                else self.Event.dropout)
+        self._event(kind, self._frames / self._RATE - duration, duration)
+
+    def _close_second(self):
+        rms = math.sqrt(self._second_energy / self._second_frames) / 32768
+        level = 20 * math.log10(rms) if rms > 0 else self._MIN_LEVEL
+        with self._lock:
+            self._levels.append(max(self._MIN_LEVEL, level))
+        self._second_energy = 0.0
+        self._second_frames = 0
+
+    def _collect_window(self, block):
+        if self._sample is None:
+            return
+        if not self._window_data:
+            self._window_start = self._frames / self._RATE
+        self._window_data += block
+        if len(self._window_data) < self._window_size:
+            return
+        try:
+            self._windows.put_nowait((self._window_start,
+                                      bytes(self._window_data)))
+        except queue.Full:
+            with self._lock:
+                self._counts['skipped'] += 1
+        self._window_data = bytearray()
+
+    def _match(self):
+        threshold = Echonest.backend().threshold
+        while True:
+            item = self._windows.get()
+            if item is None:
+                return
+            start, data = item
+            # A failed window must not end matching for good
+            try:
+                code = Echonest.codegen_pcm(data, self._RATE)
+                pairs = Echonest.parse_code(code)
+                histogram = self._library.histogram([self._sample])
+                histogram.feed(pairs)
+                name, score, alignment = histogram.results()[0]
+            except Exception:
+                log.exception('%s: Failed to match window at %.2fs'
+                              % (self._source, start))
+                with self._lock:
+                    self._counts['errors'] += 1
+                continue
+            if len(pairs) < Echonest._MIN_CODE_LEN:
+                score = 0
+            matched = score >= threshold
+
+            with self._lock:
+                self._scores.append((start, score))
+                self._counts['windows'] += 1
+                self._counts['matched'] += matched
+            if self._matched and not matched:
+                self._event(self.Event.mismatch, start, self._window)
+            self._matched = matched
+
+    def _event(self, kind, start, duration):
+        log.info('%s: %s at %.2fs (%.2fs)'
+                 % (self._source, kind, start, duration))
+        with self._lock:
+            self._events.append((start, kind, duration))
+            self._counts[kind] += 1
+            self._request_dump(kind, start - self._DUMP_BEFORE,
+                               start + duration + self._DUMP_AFTER)
+
+    def _request_dump(self, kind, start, end):
+        # Overlapping requests are served with a single dump
+        if self._dump_requests and start <= self._dump_requests[-1][2]:
+            last_kind, last_start, last_end = self._dump_requests[-1]
+            self._dump_requests[-1] = (last_kind, last_start,
+                                       max(last_end, end))
+        else:
+            self._dump_requests.append((kind, start, end))
+
+    def _dump_pending(self):
+        now = self._frames / self._RATE
+        with self._lock:
+            ready = [request for request in self._dump_requests
+                     if request[2] <= now]
+            self._dump_requests = [request for request in self._dump_requests
+                                   if request[2] > now]
+
+        for kind, start, end in ready:
+            if end <= self._capture_start:
+                # Recorded before reconnecting
+                continue
+            path = os.path.join(self._dump_dir, '%08.2f-%s.wav'
+                                                % (max(0, start), kind))
+            self._dump(path, start, end)
+            with self._lock:
+                self._dumps.append(path)
+                while len(self._dumps) > self._MAX_DUMPS:
+                    os.remove(self._dumps.popleft())
+
+    def _dump(self, path, start, end):
+        position = int((start - self._capture_start) * self._RATE) * 2
+        size = int((end - start) * self._RATE) * 2
+        reader = self._capture.ring.reader(position)
+        size -= reader.position - position
+        wav = wave.open(path, 'wb')
+        try:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self._RATE)
+            for view in reader.read(max(0, size)):
+                wav.writeframesraw(view)
+        finally:
+            wav.close()
 
 class Player:
     _REASONABLE_PLAY_BACK_WAIT_TIME = 5 # seconds
@@ -236,7 +2073,7 @@ class Player:
 
     def __init__(self):
         self._sox = None
-        self._paplay = None
+        self._pacat = None
 
     def _ensure_ready(self):
         config = btts.Config()
@@ -257,17 +2094,10 @@ class Player:
 
         if self._sox != None:
             log.info('Playback in progress. Restarting!')
-            self._sox.terminate()
             try:
-                self._sox.wait(timeout=_REASONABLE_TERMINATE_TIME)
-                self._paplay.wait(timeout=_REASONABLE_TERMINATE_TIME)
-            except subprocess.TimeoutExpired:
-                log.warning('Playback pipeline refused to terminate. Will be killed.')
-                self._sox.kill()
-                self._paplay.kill()
-            finally:
-                self._sox = None
-                self._paplay = None
+                self.stop()
+            except btts.cliutils.Failure:
+                log.warning('Playback pipeline refused to terminate. Killed.')
 
         total_duration = _duration(ifile)
         if total_duration < duration:
@@ -315,3 +2145,235 @@ class Player:
         finally:
             self._sox = None
             self._pacat = None
+
+    def stop(self):
+        '''
+        Stop playing back early.
+        '''
+        if self._sox == None:
+            raise self.NotStartedError()
+
+        self._sox.terminate()
+        self._pacat.terminate()
+        try:
+            self._sox.wait(timeout=_REASONABLE_TERMINATE_TIME)
+            self._pacat.wait(timeout=_REASONABLE_TERMINATE_TIME)
+        except subprocess.TimeoutExpired:
+            self._sox.kill()
+            self._pacat.kill()
+            raise btts.cliutils.Failure('Playback pipeline refused to terminate')
+        finally:
+            self._sox = None
+            self._pacat = None
+
+class EchoLatency:
+    '''
+    Measures the round-trip delay of audio sent over HFP to an "echo
+    service".
+
+    A probe signal (a linear chirp) is played back 'repetitions' times,
+    'interval' seconds apart, with Player. Both the audio sent (the monitor
+    of the btts_inject sink) and the echo received are captured with
+    btts.pulse.Capture, with no gate, so that every sample is timestamped.
+    Each probe is located in both captures with FFT based cross-correlation.
+    The difference of their timestamps is the delay.
+    '''
+
+    _RATE = 16000 # Hz; enough for wideband speech
+    _PROBE_DURATION = 0.5 # seconds
+    _PROBE_FREQUENCIES = (300, 3400) # Hz; narrowband speech
+    _PROBE_AMPLITUDE = 0.5
+    _INJECT_SOURCE = 'btts_inject.monitor'
+    _LEAD_TIME = 0.5 # seconds
+    # Normalized cross-correlation required to consider the probe found
+    _THRESHOLD = 0.3
+
+    class Error(Exception):
+        _dbus_error_name = 'org.merproject.btts.EchoLatency.Error'
+
+    class NoEchoError(Error):
+        def __init__(self):
+            EchoLatency.Error.__init__(self, 'No echo detected')
+
+    def __init__(self, probe_path, max_delay=2):
+        '''
+        The probe is stored at 'probe_path' for playback. Echoes are searched
+        for up to 'max_delay' seconds after each probe.
+        '''
+        # Pulls in numpy - only when needed
+        import numpy as np
+        self._np = np
+
+        self._probe_path = probe_path
+        self._max_delay = max_delay
+
+        times = np.arange(int(self._PROBE_DURATION * self._RATE)) / self._RATE
+        f0, f1 = self._PROBE_FREQUENCIES
+        sweep = (f1 - f0) / self._PROBE_DURATION
+        self._probe = np.sin(2 * np.pi * (f0 * times + sweep / 2 * times ** 2))
+        # Fade in/out to avoid clicks
+        fade = int(0.01 * self._RATE)
+        self._probe[:fade] *= np.linspace(0, 1, fade)
+        self._probe[-fade:] *= np.linspace(1, 0, fade)
+
+    def measure(self, repetitions, interval):
+        '''
+        Returns the list of delays [secs] of the echoes of the individual
+        probes, None for echoes not detected. Delays longer than the probe
+        period (probe duration plus 'interval') are not detected.
+        '''
+        np = self._np
+        assert(repetitions > 0 and interval >= 0)
+
+        period = len(self._probe) + int(interval * self._RATE)
+        signal = np.zeros(period * repetitions)
+        for i in range(repetitions):
+            signal[i * period:i * period + len(self._probe)] = self._probe
+        write_wav(self._probe_path,
+                  (signal * self._PROBE_AMPLITUDE * 32767).astype('<i2')
+                  .tobytes(), self._RATE)
+
+        card = 'bluez_card.%s' % (Recorder._device_address_for_pa())
+        source = 'bluez_source.%s' % (Recorder._device_address_for_pa())
+        try:
+            Recorder._tracker().set_card_profile(
+                    card, _pa_profile_by_bt_profile['hfp'])
+        except btts.pulse.Tracker.Error as e:
+            raise self.Error('Failed to set card profile: %s' % (e))
+
+        capacity = (len(signal) / self._RATE + self._max_delay
+                    + self._LEAD_TIME
+                    + Player._REASONABLE_PLAY_BACK_WAIT_TIME)
+        captures = [btts.pulse.Capture(device, rate=self._RATE, channels=1,
+                                       capacity=capacity)
+                    for device in (self._INJECT_SOURCE, source)]
+        player = Player()
+        try:
+            for capture in captures:
+                capture.start()
+            time.sleep(self._LEAD_TIME)
+            player.start(self._probe_path)
+            player.wait()
+            time.sleep(self._max_delay)
+        except btts.pulse.Capture.Error as e:
+            raise self.Error(str(e))
+        finally:
+            for capture in captures:
+                capture.stop()
+
+        return self._delays(captures[0], captures[1], period, repetitions)
+
+    def _delays(self, sent, received, period, repetitions):
+        np = self._np
+        if sent.start_time is None:
+            raise self.Error('Probe not played back')
+        if received.start_time is None:
+            raise self.NoEchoError()
+
+        sent_at = self._locate(self._samples(sent), period, repetitions)
+        if sent_at is None:
+            raise self.Error('Probe not played back')
+        sent_at = [sent.start_time + position / self._RATE
+                   for position in sent_at]
+
+        correlation = self._correlate(self._samples(received))
+        # Echoes of the following probes must not be mistaken
+        search = min(int(self._max_delay * self._RATE), period)
+        delays = []
+        for when in sent_at:
+            first = int((when - received.start_time) * self._RATE)
+            last = first + search
+            window = correlation[max(0, first):max(0, last)]
+            if len(window) == 0 or window.max() < self._THRESHOLD:
+                delays.append(None)
+                continue
+            position = max(0, first) + int(np.argmax(window))
+            delays.append(float(received.start_time + position / self._RATE
+                                - when))
+
+        return delays
+
+    def _samples(self, capture):
+        np = self._np
+        data = b''.join(bytes(view) for view in capture.ring.reader(0).read())
+        return np.frombuffer(data, dtype='<i2').astype(np.float64) / 32768
+
+    def _correlate(self, samples):
+        '''
+        Returns the normalized cross-correlation of 'samples' with the probe,
+        indexed by the position of the probe start.
+        '''
+        np = self._np
+        probe = self._probe
+        count = len(samples) - len(probe) + 1
+        if count <= 0:
+            return np.zeros(0)
+
+        size = 1 << int(math.ceil(math.log2(len(samples) + len(probe))))
+        spectrum = (np.fft.rfft(samples, size)
+                    * np.conj(np.fft.rfft(probe, size)))
+        correlation = np.fft.irfft(spectrum, size)[:count]
+
+        # Energy of each probe long stretch of samples
+        energy = np.concatenate(([0], np.cumsum(samples ** 2)))
+        energy = energy[len(probe):len(probe) + count] - energy[:count]
+        norm = np.sqrt(np.maximum(energy, 1e-12) * np.sum(probe ** 2))
+        return correlation / norm
+
+    def _locate(self, samples, period, repetitions):
+        '''
+        Returns the positions of the probes played back in 'samples' or None
+        '''
+        np = self._np
+        correlation = self._correlate(samples)
+        found = np.flatnonzero(correlation >= self._THRESHOLD)
+        if len(found) == 0:
+            return None
+        # The strongest peak near the first one found
+        first = found[0] + int(np.argmax(correlation[found[0]:found[0]
+                                                     + len(self._probe)]))
+        return [first + i * period for i in range(repetitions)]
+
+if __name__ == '__main__':
+    def test_minimodem():
+        message = b'The quick brown fox jumps over the lazy dog. 0123456789'
+
+        # Fed in chunks not aligned to bytes or bits, to cover the
+        # incremental paths
+        encoder = Minimodem.Encoder()
+        data = b''.join(encoder.feed(message[i:i + 7])
+                        for i in range(0, len(message), 7))
+        data += encoder.finish()
+
+        decoder = Minimodem.Decoder(Minimodem._RATE)
+        for i in range(0, len(data), 1001 * 2):
+            decoder.feed(data[i:i + 1001 * 2])
+
+        received = decoder.drain()
+        assert received == message, received
+        print('minimodem: %d bytes round trip OK' % (len(message)))
+
+    def test_error_counter():
+        expected = bytes(bytearray(range(32, 128)))
+        received = bytearray(expected)
+        del received[20:23]
+        received[50:50] = b'\0\0'
+        received[70] ^= 0x81
+
+        counter = Minimodem.ErrorCounter(bytearray(expected), 32)
+        for i in range(0, len(received), 5):
+            counter.feed(bytes(received[i:i + 5]))
+        counter.finish()
+
+        totals = counter.totals
+        assert totals[counter.LOST] == 3, totals
+        assert totals[counter.INSERTED] == 2, totals
+        assert totals[counter.BIT_ERRORS] == 2, totals
+        assert totals[counter.COMPARED] == len(expected) - 3, totals
+        assert counter.complete
+        print('error counter: %d lost, %d inserted, %d bit errors OK'
+              % (totals[counter.LOST], totals[counter.INSERTED],
+                 totals[counter.BIT_ERRORS]))
+
+    test_minimodem()
+    test_error_counter()
@@ -0,0 +1,196 @@
+#
+# BTTS - BlueTooth Test Suite
+#
+# Copyright (C) 2014 Jolla Ltd.
+# Contact: Martin Kampas <martin.kampas@jollamobile.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import dbus
+import logging
+import os
+
+import btts.utils
+
+log = logging.getLogger(__name__)
+
+BLUEZ_BUS_NAME = 'org.bluez'
+
+# Shared connections and proxies. Creating a proxy is not for free - it
+# introspects the remote object.
+_buses = {}
+_objects = {}
+
+def system_bus():
+    if 'system' not in _buses:
+        _buses['system'] = dbus.SystemBus()
+    return _buses['system']
+
+def session_bus():
+    if 'session' not in _buses:
+        _buses['session'] = dbus.SessionBus()
+    return _buses['session']
+
+def get_object(bus_name, path, bus=None):
+    bus = bus or system_bus()
+    key = (id(bus), bus_name, path)
+    if key not in _objects:
+        _objects[key] = bus.get_object(bus_name, path)
+    return _objects[key]
+
+def get_interface(bus_name, path, interface, bus=None):
+    return dbus.Interface(get_object(bus_name, path, bus), interface)
+
+class ObjectTree:
+    '''
+    Process-wide mirror of the object tree exported by bluez.
+
+    Populated with a single GetManagedObjects call and kept current through
+    the InterfacesAdded, InterfacesRemoved and PropertiesChanged signals (as
+    long as the main loop is running). Use ObjectTree.instance().
+    '''
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = ObjectTree()
+        return cls._instance
+
+    def __init__(self):
+        self._bus = system_bus()
+
+        self._interfaces_by_path = {}
+        self._adapter_path_by_name = {}
+        self._device_paths_by_address = {}
+
+        # Subscribe first so no change is lost in between
+        self._bus.add_signal_receiver(
+                self._on_interfaces_added,
+                bus_name=BLUEZ_BUS_NAME,
+                dbus_interface='org.freedesktop.DBus.ObjectManager',
+                signal_name='InterfacesAdded')
+        self._bus.add_signal_receiver(
+                self._on_interfaces_removed,
+                bus_name=BLUEZ_BUS_NAME,
+                dbus_interface='org.freedesktop.DBus.ObjectManager',
+                signal_name='InterfacesRemoved')
+        self._bus.add_signal_receiver(
+                self._on_properties_changed,
+                bus_name=BLUEZ_BUS_NAME,
+                dbus_interface=dbus.PROPERTIES_IFACE,
+                signal_name='PropertiesChanged',
+                path_keyword='path')
+
+        manager = get_interface(BLUEZ_BUS_NAME, '/',
+                                'org.freedesktop.DBus.ObjectManager')
+        for path, interfaces in manager.GetManagedObjects().items():
+            self._add(path, interfaces)
+
+    def paths(self):
+        return list(self._interfaces_by_path)
+
+    def interfaces(self, path):
+        '''
+        Returns dictionary of interfaces and their properties for the given
+        object path or None.
+        '''
+        return self._interfaces_by_path.get(path)
+
+    def properties(self, path, interface):
+        return self._interfaces_by_path.get(path, {}).get(interface)
+
+    def adapters(self):
+        '''
+        Returns dictionary of adapter object paths by adapter name
+        (e.g. "hci0")
+        '''
+        return dict(self._adapter_path_by_name)
+
+    def adapter_path(self, name):
+        return self._adapter_path_by_name.get(name)
+
+    def device_paths(self, address):
+        return set(self._device_paths_by_address.get(address.lower(), ()))
+
+    def device_path(self, adapter_path, address):
+        for path in self._device_paths_by_address.get(address.lower(), ()):
+            if path.startswith(adapter_path + '/'):
+                return path
+        return None
+
+    @btts.utils.signal
+    def interfaces_added(self, path, interfaces):
+        pass
+
+    @btts.utils.signal
+    def interfaces_removed(self, path, interfaces):
+        pass
+
+    @btts.utils.signal
+    def properties_changed(self, path, interface, changed, invalidated):
+        pass
+
+    def _add(self, path, interfaces):
+        known = self._interfaces_by_path.setdefault(path, {})
+        for interface, properties in interfaces.items():
+            known.setdefault(interface, {}).update(properties)
+
+        if 'org.bluez.Adapter1' in interfaces:
+            self._adapter_path_by_name[os.path.basename(path)] = path
+
+        device_properties = interfaces.get('org.bluez.Device1')
+        if device_properties is not None and 'Address' in device_properties:
+            address = device_properties['Address'].lower()
+            self._device_paths_by_address.setdefault(address, set()).add(path)
+
+    def _remove(self, path, interfaces):
+        known = self._interfaces_by_path.get(path, {})
+
+        if 'org.bluez.Adapter1' in interfaces:
+            name = os.path.basename(path)
+            if self._adapter_path_by_name.get(name) == path:
+                del self._adapter_path_by_name[name]
+
+        if 'org.bluez.Device1' in interfaces:
+            device_properties = known.get('org.bluez.Device1', {})
+            address = device_properties.get('Address', '').lower()
+            paths = self._device_paths_by_address.get(address, set())
+            paths.discard(path)
+            if not paths:
+                self._device_paths_by_address.pop(address, None)
+
+        for interface in interfaces:
+            known.pop(interface, None)
+        if not known:
+            self._interfaces_by_path.pop(path, None)
+
+    def _on_interfaces_added(self, path, interfaces):
+        self._add(path, interfaces)
+        self.interfaces_added(path, interfaces)
+
+    def _on_interfaces_removed(self, path, interfaces):
+        self._remove(path, interfaces)
+        self.interfaces_removed(path, interfaces)
+
+    def _on_properties_changed(self, interface, changed, invalidated, path):
+        properties = self._interfaces_by_path.get(path, {}).get(interface)
+        if properties is None:
+            return
+        properties.update(changed)
+        for name in invalidated:
+            properties.pop(name, None)
+        self.properties_changed(path, interface, changed, invalidated)
@@ -19,7 +19,6 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import argparse
-import dbus
 import sys
 
 class Failure(Exception):
@@ -31,7 +30,9 @@ class BadUsage(Exception):
 def _match_exc(matched_exc, wanted_exc_type):
     if isinstance(matched_exc, wanted_exc_type):
         return True
-    if isinstance(matched_exc, dbus.DBusException):
+    # Not importing dbus unless there is a chance to see its exception
+    dbus = sys.modules.get('dbus')
+    if dbus is not None and isinstance(matched_exc, dbus.DBusException):
         wanted_dbus_error_name = getattr(wanted_exc_type, '_dbus_error_name', None)
         if wanted_dbus_error_name is not None:
             if matched_exc.get_dbus_name() == wanted_dbus_error_name:
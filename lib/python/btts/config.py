@@ -16,25 +16,35 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from gi.repository import Gio
 import copy
-import dbus
 import glob
 import logging
 import os
 import re
 
-from btts.adapter import Adapter
-from btts.device import Device
+import btts
+import btts.utils
 
 log = logging.getLogger(__name__)
 
 _ADAPTERS_FILE = "/etc/btts/adapters"
 _GSETTINGS_SCHEMA = "org.merproject.btts"
+# Relocatable, for named sessions, see btts.session
+_GSETTINGS_SESSION_SCHEMA = "org.merproject.btts.session"
+_GSETTINGS_SESSION_PATH = "/org/merproject/btts/sessions/%s/"
+
+def _new_settings():
+    from gi.repository import Gio
+    import btts.session
+    session = btts.session.name()
+    if not session:
+        return Gio.Settings.new(_GSETTINGS_SCHEMA)
+    return Gio.Settings.new_with_path(_GSETTINGS_SESSION_SCHEMA,
+                                      _GSETTINGS_SESSION_PATH % (session))
 
 class Config:
     class Error(Exception):
-        pass
+        _dbus_error_name = 'org.merproject.btts.Config.Error'
 
     class NoSuchAdapterError(Error):
         def __init__(self, adapter):
@@ -63,10 +73,27 @@ class Config:
         def __init__(self):
             Config.Error.__init__(self, "Timeout")
 
+    # Managers are shared by all Config instances in the process and keep
+    # themselves up to date. Constructing a Config is cheap this way.
+    _managers = None
+
     def __init__(self):
-        self._adapter_manager = Config._AdapterManager()
-        self._device_manager = Config._DeviceManager()
-        self._profile_manager = Config._ProfileManager()
+        if Config._managers is None:
+            Config._managers = (Config._AdapterManager(),
+                                Config._DeviceManager(),
+                                Config._ProfileManager())
+        (self._adapter_manager, self._device_manager,
+         self._profile_manager) = Config._managers
+
+    @btts.utils.signal
+    def changed(self, key):
+        '''
+        Emitted when a setting changes - key is one of "adapter", "device",
+        "host-alias" - or when the set of available adapters changes - key is
+        "adapters". Change of a setting made by another process is only
+        noticed while the main loop is running.
+        '''
+        pass
 
     @property
     def adapter_no_alias(self):
@@ -108,8 +135,22 @@ class Config:
 
     class _AdapterManager:
         def __init__(self):
-            self.settings = Gio.Settings.new(_GSETTINGS_SCHEMA)
+            import btts.bus
+            self.settings = _new_settings()
+
+            # Connect before reading - GSettings only notifies about keys
+            # read at least once
+            self.settings.connect('changed', self._on_settings_changed)
+            self._adapter = self.settings.get_string("adapter")
+            self._host_alias = self.settings.get_string("host-alias")
 
+            self._update_adapters()
+
+            tree = btts.bus.ObjectTree.instance()
+            tree.interfaces_added.connect(self._on_interfaces_changed)
+            tree.interfaces_removed.connect(self._on_interfaces_changed)
+
+        def _update_adapters(self):
             self._name_by_address = self._read_names()
             self._address_by_name = dict(zip(self._name_by_address.values(),
                                              self._name_by_address.keys()))
@@ -124,8 +165,23 @@ class Config:
                                 (_ADAPTERS_FILE, address))
                     del self._address_by_alias[alias]
 
+        def _on_settings_changed(self, settings, key):
+            if key == "adapter":
+                self._adapter = settings.get_string(key)
+            elif key == "host-alias":
+                self._host_alias = settings.get_string(key)
+            else:
+                return
+            Config.changed(key)
+
+        def _on_interfaces_changed(self, path, interfaces):
+            if 'org.bluez.Adapter1' not in interfaces:
+                return
+            self._update_adapters()
+            Config.changed("adapters")
+
         def adapter_no_alias(self):
-            name = self.settings.get_string("adapter")
+            name = self._adapter
             if not name:
                 raise Config.AdapterNotSetError()
             if not name in self._address_by_name:
@@ -148,7 +204,7 @@ class Config:
                 raise Config.NoSuchAdapterError(adapter=name_or_alias)
 
             try:
-                adapter = Adapter()
+                adapter = btts.Adapter()
                 adapter.properties_iface.Set('org.bluez.Adapter1', 'Alias', '')
                 # Even if DOWN, it can still be discovered until explicitly disabled
                 adapter.discoverable = False
@@ -157,22 +213,23 @@ class Config:
                 pass
 
             self.settings.set_string("adapter", name)
+            self._adapter = name
 
             try:
-                adapter = Adapter()
+                adapter = btts.Adapter()
                 adapter.properties_iface.Set('org.bluez.Adapter1', 'Alias',
                                              self.host_alias())
             except Config.AdapterNotSetError:
                 pass
 
         def host_alias(self):
-            host_alias = self.settings.get_string("host-alias")
-            return host_alias
+            return self._host_alias
 
         def set_host_alias(self, host_alias):
             self.settings.set_string("host-alias", host_alias)
+            self._host_alias = host_alias
             try:
-                adapter = Adapter()
+                adapter = btts.Adapter()
                 adapter.properties_iface.Set('org.bluez.Adapter1', 'Alias', host_alias)
             except Config.AdapterNotSetError:
                 pass
@@ -193,34 +250,40 @@ class Config:
 
         @staticmethod
         def _read_names():
+            import btts.bus
             names = {}
-            bus = dbus.SystemBus()
-            manager = dbus.Interface(bus.get_object("org.bluez", "/"),
-                                     "org.freedesktop.DBus.ObjectManager")
-            objects = manager.GetManagedObjects()
-            for path, properties in objects.items():
-                adapter_properties = properties.get('org.bluez.Adapter1')
-                if adapter_properties is not None:
-                    name = os.path.basename(path)
-                    address = adapter_properties['Address'].lower()
-                    names[address] = name
+            tree = btts.bus.ObjectTree.instance()
+            for name, path in tree.adapters().items():
+                adapter_properties = tree.properties(path, 'org.bluez.Adapter1')
+                address = adapter_properties['Address'].lower()
+                names[address] = name
             return names
 
     class _DeviceManager:
         def __init__(self):
-            self.settings = Gio.Settings.new(_GSETTINGS_SCHEMA)
+            self.settings = _new_settings()
+
+            self.settings.connect('changed', self._on_settings_changed)
+            self._device = self.settings.get_string("device").lower()
+
+        def _on_settings_changed(self, settings, key):
+            if key != "device":
+                return
+            self._device = settings.get_string(key).lower()
+            Config.changed(key)
 
         def device(self):
-            address = self.settings.get_string("device").lower()
+            address = self._device
             if not address:
                 raise Config.DeviceNotSetError()
             return address
 
         def set_device(self, address):
-            if not Device.is_valid_address(address):
+            if not btts.Device.is_valid_address(address):
                 raise Config.InvalidAddressError(address)
 
             self.settings.set_string("device", address.lower())
+            self._device = address.lower()
 
     class _ProfileManager:
         _REASONABLE_TIMEOUT = 5000
@@ -233,9 +296,11 @@ class Config:
         valid_profile_names = _unit_by_bt_profile.keys()
 
         def __init__(self):
-            self._bus = dbus.SystemBus()
-            manager_object = self._bus.get_object('org.freedesktop.systemd1',
-                                                  '/org/freedesktop/systemd1')
+            import dbus
+            import btts.bus
+            self._bus = btts.bus.system_bus()
+            manager_object = btts.bus.get_object('org.freedesktop.systemd1',
+                                                 '/org/freedesktop/systemd1')
             self._systemd_manager = dbus.Interface(
                     manager_object, "org.freedesktop.systemd1.Manager")
             self._job = None
@@ -252,6 +317,7 @@ class Config:
             return states
 
         def set_profile_enabled(self, profile, enabled=True):
+            from gi.repository import GObject
             assert not self._job
             if not profile in self.valid_profile_names:
                 raise Config.NoSuchProfileError(profile)
@@ -261,8 +327,9 @@ class Config:
 
             self._job_result = None
 
-            self._systemd_manager.connect_to_signal("JobRemoved",
-                                                    self._on_job_removed)
+            # The manager is shared - do not leave the receiver behind
+            match = self._systemd_manager.connect_to_signal(
+                    "JobRemoved", self._on_job_removed)
 
             if enabled:
                 self._job = unit.Start("replace")
@@ -270,8 +337,12 @@ class Config:
                 self._job = unit.Stop("replace")
 
             self._loop = GObject.MainLoop()
-            GObject.timeout_add(_REASONABLE_TIMEOUT, self._loop.quit)
-            self._loop.run()
+            GObject.timeout_add(self._REASONABLE_TIMEOUT, self._loop.quit)
+            try:
+                self._loop.run()
+            finally:
+                match.remove()
+                self._job = None
 
             if self._job_result == None:
                 raise Config.TimeoutError()
@@ -280,17 +351,21 @@ class Config:
                                    (unit_name, self._job_result))
 
         def _get_unit(self, unit_name):
+            import dbus
+            import btts.bus
             unit_path = self._systemd_manager.GetUnit(unit_name)
-            unit_object = self._bus.get_object('org.freedesktop.systemd1',
-                                               unit_path)
+            unit_object = btts.bus.get_object('org.freedesktop.systemd1',
+                                              unit_path)
             unit = dbus.Interface(unit_object,
                                   dbus_interface='org.freedesktop.systemd1.Unit')
             return unit
 
         def _get_unit_properties(self, unit_name):
+            import dbus
+            import btts.bus
             unit_path = self._systemd_manager.GetUnit(unit_name)
-            unit_object = self._bus.get_object('org.freedesktop.systemd1',
-                                               unit_path)
+            unit_object = btts.bus.get_object('org.freedesktop.systemd1',
+                                              unit_path)
             properties = dbus.Interface(unit_object,
                                         dbus_interface=dbus.PROPERTIES_IFACE)
             return properties
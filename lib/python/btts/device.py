@@ -16,10 +16,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import dbus
 import re
+import time
 
 import btts
+import btts.bus
 
 class Device:
     class Error(Exception):
@@ -38,15 +41,32 @@ class Device:
         self._device_object = None
         self._properties_iface = None
 
-        bus = dbus.SystemBus()
-        manager = dbus.Interface(bus.get_object("org.bluez", "/"),
-                                 "org.freedesktop.DBus.ObjectManager")
-        objects = manager.GetManagedObjects()
-        for path, properties in objects.items():
-            self._on_interfaces_added(path, properties)
+        tree = btts.bus.ObjectTree.instance()
+        try:
+            path = tree.device_path(self._adapter.path, self._config.device)
+            if path is not None:
+                self._on_interfaces_added(path, tree.interfaces(path))
+        except (btts.Config.DeviceNotSetError,
+                btts.Config.AdapterNotSetError) as e:
+            self._error = type(e)
+
+        tree.interfaces_added.connect(self._on_interfaces_added)
+        tree.interfaces_removed.connect(self._on_interfaces_removed)
+
+    def __enter__(self):
+        return self
 
-        manager.connect_to_signal('InterfacesAdded', self._on_interfaces_added)
-        manager.connect_to_signal('InterfacesRemoved', self._on_interfaces_removed)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''
+        Stop tracking the device. The object tree is shared for the whole life
+        of the process - without this the instance is never released.
+        '''
+        tree = btts.bus.ObjectTree.instance()
+        tree.interfaces_added.disconnect(self._on_interfaces_added)
+        tree.interfaces_removed.disconnect(self._on_interfaces_removed)
 
     def _ensure_available(self):
         if self._error:
@@ -104,8 +124,8 @@ class Device:
                 if (device_properties is not None and
                         device_properties['Address'].lower() == self._config.device):
                     self._path = object_path
-                    bus = dbus.SystemBus()
-                    self._device_object = bus.get_object('org.bluez', self._path)
+                    self._device_object = btts.bus.get_object('org.bluez',
+                                                              self._path)
                     self._properties_iface = dbus.Interface(self._device_object,
                                                             dbus.PROPERTIES_IFACE)
                     self.available_changed(True)
@@ -118,3 +138,167 @@ class Device:
         if object_path == self._path:
             self._path = None
             self.available_changed(False)
+
+class PresenceTracker:
+    '''
+    Process-wide history of the presence of remote devices, kept from bluez
+    signals (see btts.bus.ObjectTree) as long as the main loop is running.
+    Use PresenceTracker.instance().
+
+    A device is heard when its object appears, when it reports RSSI during
+    discovery (by any client) and all the time it is connected. Per address
+    the time it was last heard, the last RSSI_HISTORY RSSI values and the
+    connection state are kept. Times are as returned by time.monotonic().
+    '''
+
+    RSSI_HISTORY = 32
+
+    class Record:
+        def __init__(self, address):
+            self.address = address
+            self.name = None
+            # Whether bluez has an object for the device
+            self.known = False
+            self.connected = False
+            self.last_seen = None
+            # (time, RSSI) pairs
+            self.rssi = collections.deque(maxlen=PresenceTracker.RSSI_HISTORY)
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = PresenceTracker()
+        return cls._instance
+
+    def __init__(self):
+        self._tree = btts.bus.ObjectTree.instance()
+        self._records = {}
+        # The tree forgets the address of a removed object before telling
+        self._address_by_path = {}
+        self._discovering_since = {}
+
+        # Subscribe first so no change is lost in between
+        self._tree.interfaces_added.connect(self._on_interfaces_added)
+        self._tree.interfaces_removed.connect(self._on_interfaces_removed)
+        self._tree.properties_changed.connect(self._on_properties_changed)
+
+        now = time.monotonic()
+        for path in self._tree.paths():
+            properties = self._tree.properties(path, 'org.bluez.Adapter1')
+            if properties is not None and properties.get('Discovering'):
+                self._discovering_since[path] = now
+
+            properties = self._tree.properties(path, 'org.bluez.Device1')
+            if properties is not None and 'Address' in properties:
+                record = self._record(properties['Address'])
+                self._address_by_path[path] = record.address
+                record.known = True
+                record.name = properties.get('Name')
+                record.connected = bool(properties.get('Connected'))
+                if record.connected:
+                    record.last_seen = now
+
+    def record(self, address):
+        '''
+        Returns the Record for the given address or None if never known
+        '''
+        return self._records.get(address.lower())
+
+    def records(self):
+        return [self._records[address] for address in sorted(self._records)]
+
+    def age(self, address):
+        '''
+        Returns the number of seconds since the device was last heard, 0 while
+        connected, None if never heard
+        '''
+        record = self.record(address)
+        if record is None or record.last_seen is None:
+            return None
+        if record.connected:
+            return 0
+        return time.monotonic() - record.last_seen
+
+    def discovering_since(self, adapter_path):
+        '''
+        Returns the time the adapter started discovery or None if it is not
+        discovering
+        '''
+        return self._discovering_since.get(adapter_path)
+
+    @btts.utils.signal
+    def heard(self, address):
+        pass
+
+    @btts.utils.signal
+    def discovering_changed(self, adapter_path, discovering):
+        pass
+
+    def _record(self, address):
+        address = address.lower()
+        if address not in self._records:
+            self._records[address] = self.Record(address)
+        return self._records[address]
+
+    def _update(self, path, changed, heard):
+        properties = self._tree.properties(path, 'org.bluez.Device1') or {}
+        address = properties.get('Address', changed.get('Address'))
+        if address is None:
+            return
+        record = self._record(address)
+        self._address_by_path[path] = record.address
+        now = time.monotonic()
+
+        record.known = True
+        if 'Name' in changed:
+            record.name = changed['Name']
+        if 'RSSI' in changed:
+            record.rssi.append((now, int(changed['RSSI'])))
+            heard = True
+        if 'Connected' in changed:
+            # It was there until now at least
+            heard = heard or record.connected or changed['Connected']
+            record.connected = bool(changed['Connected'])
+
+        if heard:
+            record.last_seen = now
+            self.heard(record.address)
+
+    def _set_discovering(self, adapter_path, discovering):
+        if discovering == (adapter_path in self._discovering_since):
+            return
+        if discovering:
+            self._discovering_since[adapter_path] = time.monotonic()
+        else:
+            del self._discovering_since[adapter_path]
+        self.discovering_changed(adapter_path, discovering)
+
+    def _on_interfaces_added(self, path, interfaces):
+        if 'org.bluez.Device1' in interfaces:
+            self._update(path, interfaces['org.bluez.Device1'], heard=True)
+        if 'org.bluez.Adapter1' in interfaces:
+            self._set_discovering(
+                    path, bool(interfaces['org.bluez.Adapter1'].get(
+                                   'Discovering')))
+
+    def _on_interfaces_removed(self, path, interfaces):
+        if 'org.bluez.Adapter1' in interfaces:
+            self._set_discovering(path, False)
+        if 'org.bluez.Device1' not in interfaces:
+            return
+        address = self._address_by_path.pop(path, None)
+        if address is None:
+            return
+        record = self._records[address]
+        record.known = address in self._address_by_path.values()
+        if record.connected:
+            record.connected = False
+            record.last_seen = time.monotonic()
+
+    def _on_properties_changed(self, path, interface, changed, invalidated):
+        if interface == 'org.bluez.Device1':
+            self._update(path, changed, heard=False)
+        elif interface == 'org.bluez.Adapter1' and 'Discovering' in changed:
+            self._set_discovering(path, bool(changed['Discovering']))
@@ -0,0 +1,219 @@
+#
+# BTTS - BlueTooth Test Suite
+#
+# Copyright (C) 2014 Jolla Ltd.
+# Contact: Martin Kampas <martin.kampas@jollamobile.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+In-process audio fingerprinting based on spectral peak landmarks.
+
+Audio is analysed at RATE, mono. Local maxima of the log magnitude STFT are
+selected (at most _PEAKS_PER_SECOND per second) and each peak is paired with
+the next _FAN_OUT peaks. A pair is hashed as (f1, f2, dt) into 24 bits, with
+dt quantized to _DT_STEP frames, and stored together with the time offset (in
+frames) of the first peak.
+
+The code string representation is compatible with the one produced by
+echoprint-codegen ("hash offset hash offset ..."), so it can be stored and
+matched by btts.Echonest the same way.
+'''
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import numpy as np
+import subprocess
+
+RATE = 11025 # Hz
+
+_FRAME = 1024 # samples
+_HOP = 256 # samples; ~23ms
+_FREQ_BINS = 512 # Nyquist bin dropped, so f fits in 9 bits
+_BLOCK = 2048 # frames processed at once - bounds memory use
+
+_NEIGHBOURHOOD_FREQ = 15 # bins, each side
+_NEIGHBOURHOOD_TIME = 7 # frames, each side
+_MIN_MAGNITUDE = 0.1 # ignore (digital) silence
+_PEAKS_PER_SECOND = 30
+
+_FAN_OUT = 5
+_MAX_DT = 63 # frames
+_DT_STEP = 3 # frames; tolerates misaligned framing
+
+_window = np.hanning(_FRAME).astype(np.float32)
+
+class Fingerprint:
+    '''
+    Landmark hashes with their time offsets, both as integer arrays, ordered
+    by offset.
+    '''
+
+    def __init__(self, hashes, offsets):
+        self.hashes = np.asarray(hashes, dtype=np.uint32)
+        self.offsets = np.asarray(offsets, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def to_code_string(self):
+        pairs = np.column_stack((self.hashes, self.offsets)).ravel()
+        return ' '.join(map(str, pairs.tolist()))
+
+    @staticmethod
+    def from_code_string(code):
+        pairs = np.array(code.split(), dtype=np.int64).reshape(-1, 2)
+        return Fingerprint(pairs[:, 0], pairs[:, 1])
+
+def decode(file_path, start=0, duration=None):
+    '''
+    Decode an audio file (any format supported by SoX) to mono float samples
+    at RATE, optionally just 'duration' seconds from 'start'.
+    '''
+    cmd = ('sox -q %s -t raw -r %d -c 1 -e signed-integer -b 16 -'
+           % (file_path, RATE)).split()
+    if start or duration is not None:
+        cmd += ['trim', str(start)]
+        if duration is not None:
+            cmd += [str(duration)]
+    out = subprocess.check_output(cmd, stdin=subprocess.DEVNULL)
+    return np.frombuffer(out, dtype='<i2').astype(np.float32) / 32768
+
+def from_pcm(data, rate, channels=1):
+    '''
+    Convert interleaved signed 16 bit little endian PCM data to mono float
+    samples at RATE.
+    '''
+    samples = np.frombuffer(data, dtype='<i2')
+    samples = samples[:len(samples) - len(samples) % channels]
+    samples = samples.reshape(-1, channels).mean(axis=1, dtype=np.float32)
+    samples /= 32768
+
+    if rate == RATE:
+        return samples
+    if rate % RATE == 0:
+        # Averaging doubles as a (crude) low-pass filter
+        factor = rate // RATE
+        samples = samples[:len(samples) - len(samples) % factor]
+        return samples.reshape(-1, factor).mean(axis=1)
+    times = np.arange(0, len(samples) / rate, 1 / RATE)
+    return np.interp(times, np.arange(len(samples)) / rate,
+                     samples).astype(np.float32)
+
+def fingerprint(samples):
+    '''
+    Compute the Fingerprint of mono float samples at RATE.
+    '''
+    samples = np.ascontiguousarray(samples, dtype=np.float32)
+
+    times = []
+    freqs = []
+    magnitudes = []
+    # Blocks overlap so peaks near block boundaries see their whole
+    # neighbourhood
+    frame_count = max(0, 1 + (len(samples) - _FRAME) // _HOP)
+    for start in range(0, frame_count, _BLOCK):
+        first = max(0, start - _NEIGHBOURHOOD_TIME)
+        last = min(frame_count, start + _BLOCK + _NEIGHBOURHOOD_TIME)
+        spectrum = _spectrogram(samples, first, last)
+        t, f, m = _peaks(spectrum)
+        t += first
+        inside = (t >= start) & (t < start + _BLOCK)
+        times.append(t[inside])
+        freqs.append(f[inside])
+        magnitudes.append(m[inside])
+
+    if not times:
+        return Fingerprint([], [])
+
+    t, f = _thin(np.concatenate(times), np.concatenate(freqs),
+                 np.concatenate(magnitudes))
+    return _landmarks(t, f)
+
+def _spectrogram(samples, first, last):
+    frames = np.lib.stride_tricks.as_strided(
+            samples[first * _HOP:],
+            shape=(last - first, _FRAME),
+            strides=(samples.strides[0] * _HOP, samples.strides[0]))
+    spectrum = np.abs(np.fft.rfft(frames * _window, axis=1))
+    return np.log(spectrum[:, :_FREQ_BINS] + 1e-6).astype(np.float32)
+
+def _max_filter(a, size, axis):
+    # Separable sliding maximum over [i - size, i + size]
+    out = a.copy()
+    for shift in range(1, size + 1):
+        lead = [slice(None)] * a.ndim
+        lag = [slice(None)] * a.ndim
+        lead[axis] = slice(shift, None)
+        lag[axis] = slice(None, -shift)
+        np.maximum(out[tuple(lead)], a[tuple(lag)], out=out[tuple(lead)])
+        np.maximum(out[tuple(lag)], a[tuple(lead)], out=out[tuple(lag)])
+    return out
+
+def _peaks(spectrum):
+    local_max = _max_filter(_max_filter(spectrum, _NEIGHBOURHOOD_TIME, 0),
+                            _NEIGHBOURHOOD_FREQ, 1)
+    is_peak = (spectrum == local_max) & (spectrum > np.log(_MIN_MAGNITUDE))
+    t, f = np.nonzero(is_peak)
+    return t, f, spectrum[t, f]
+
+def _thin(t, f, m):
+    '''
+    Keep the _PEAKS_PER_SECOND strongest peaks of each second
+    '''
+    second = t // (RATE // _HOP)
+    order = np.lexsort((-m, second))
+    t, f, second = t[order], f[order], second[order]
+
+    group_start = np.concatenate(([0], np.flatnonzero(np.diff(second)) + 1))
+    group_len = np.diff(np.concatenate((group_start, [len(second)])))
+    rank = np.arange(len(second)) - np.repeat(group_start, group_len)
+    keep = rank < _PEAKS_PER_SECOND
+    t, f = t[keep], f[keep]
+
+    order = np.lexsort((f, t))
+    return t[order], f[order]
+
+def _landmarks(t, f):
+    hashes = []
+    offsets = []
+    for j in range(1, _FAN_OUT + 1):
+        dt = t[j:] - t[:-j]
+        valid = (dt > 0) & (dt <= _MAX_DT)
+        dt = (dt[valid] + _DT_STEP // 2) // _DT_STEP
+        hashes.append((f[:-j][valid] << 15) | (f[j:][valid] << 6) | dt)
+        offsets.append(t[:-j][valid])
+
+    hashes = np.concatenate(hashes)
+    offsets = np.concatenate(offsets)
+    order = np.argsort(offsets, kind='mergesort')
+    return Fingerprint(hashes[order], offsets[order])
+
+class SpectralBackend:
+    '''
+    btts.Echonest backend using this module
+    '''
+
+    name = 'spectral'
+    # Chance alignments stay well below 1%
+    threshold = 0.05
+    offset_unit = _HOP / RATE # seconds
+    # Duration fingerprinted by default
+    default_duration = None # whole file
+
+    def codegen(self, file_path, start=0, duration=None):
+        return fingerprint(decode(file_path, start,
+                                  duration)).to_code_string()
+
+    def codegen_pcm(self, data, rate, channels=1):
+        return fingerprint(from_pcm(data, rate, channels)).to_code_string()
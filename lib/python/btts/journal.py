@@ -0,0 +1,115 @@
+#
+# BTTS - BlueTooth Test Suite
+#
+# Copyright (C) 2014 Jolla Ltd.
+# Contact: Martin Kampas <martin.kampas@jollamobile.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Server side state journals.
+
+Tool servers record the transitions of their states in a StateJournal, so
+that clients can wait for a state with a single (asynchronous) D-Bus call
+instead of reading the state and subscribing to its change signal - a
+transition happening in between would be lost, as well as any transition
+but the first one.
+'''
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import collections
+from   gi.repository import GObject
+import logging
+
+log = logging.getLogger(__name__)
+
+class StateJournal:
+    '''
+    Sequence-numbered ring journal of the transitions of a state.
+
+    The initial state has sequence number 0, each recorded transition gets
+    the next one. Only the last 'size' entries are kept. Waiting requires a
+    running GObject main loop.
+    '''
+
+    def __init__(self, name, initial, size=64):
+        self.name = name
+        self._entries = collections.deque([(0, initial)], maxlen=size)
+        # (state, reply handler, timeout source) triples
+        self._waiters = []
+
+    @property
+    def state(self):
+        return self._entries[-1][1]
+
+    @property
+    def seq(self):
+        return self._entries[-1][0]
+
+    def entries(self, since=-1):
+        '''
+        Returns the kept (seq, state) entries recorded after 'since'
+        '''
+        return [entry for entry in self._entries if entry[0] > since]
+
+    def record(self, state):
+        '''
+        Record a transition to 'state'. Returns False (recording nothing)
+        when already in that state.
+        '''
+        if state == self.state:
+            return False
+        seq = self.seq + 1
+        log.debug('%s: %s -> %s (%d)' % (self.name, self.state, state, seq))
+        self._entries.append((seq, state))
+
+        for waiter in list(self._waiters):
+            if waiter[0] == state:
+                self._waiters.remove(waiter)
+                GObject.source_remove(waiter[2])
+                waiter[1](True, seq)
+
+        return True
+
+    def wait(self, state, since, timeout, reply_handler):
+        '''
+        Wait for 'state' - call reply_handler(matched, seq) as soon as it is
+        entered, or after 'timeout' seconds.
+
+        The current state always counts. With non-negative 'since', so does
+        any transition recorded after the entry with that sequence number,
+        even if it was left already. On match 'seq' is the sequence number of
+        the earliest matching entry, otherwise that of the current state - use
+        it as 'since' to wait for a later state without missing transitions
+        in between.
+        '''
+        if since >= 0 and since + 1 < self._entries[0][0]:
+            log.warning('%s: Transitions since %d dropped from journal'
+                        % (self.name, since))
+
+        first = since + 1 if since >= 0 else self.seq
+        for seq, state_ in self.entries(min(first, self.seq) - 1):
+            if state_ == state:
+                reply_handler(True, seq)
+                return
+
+        waiter = [state, reply_handler, None]
+        def on_timeout():
+            self._waiters.remove(waiter)
+            log.warning('%s: Timeout waiting for %s, current: %s'
+                        % (self.name, state, self.state))
+            reply_handler(False, self.seq)
+            return False
+        waiter[2] = GObject.timeout_add(int(timeout * 1000), on_timeout)
+        self._waiters.append(waiter)
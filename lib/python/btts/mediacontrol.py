@@ -22,6 +22,15 @@ class MediaControl:
     def __init__(self):
         self._device = btts.Device()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._device.close()
+
     def __getattr__(self, member):
         if member.startswith('__') and member.endswith('__'):
             raise AttributeError(member)
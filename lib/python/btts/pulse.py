@@ -0,0 +1,1008 @@
+#
+# BTTS - BlueTooth Test Suite
+#
+# Copyright (C) 2014 Jolla Ltd.
+# Contact: Martin Kampas <martin.kampas@jollamobile.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+In-process PulseAudio client.
+
+A minimal ctypes binding of libpulse, using the threaded main loop API. The
+server is selected the usual way, i.e. by the PULSE_SERVER environment
+variable.
+
+Each client (Capture, Tracker) runs its own main loop thread. Callbacks are
+invoked from that thread, with the main loop locked.
+'''
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import collections
+import ctypes
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_PA_SAMPLE_S16LE = 3
+_PA_CONTEXT_READY = 4
+_PA_CONTEXT_FAILED = 5
+_PA_CONTEXT_TERMINATED = 6
+_PA_STREAM_READY = 2
+_PA_STREAM_FAILED = 3
+_PA_STREAM_TERMINATED = 4
+_PA_OPERATION_RUNNING = 0
+
+_PA_SUBSCRIPTION_MASK_SINK = 0x0001
+_PA_SUBSCRIPTION_MASK_SOURCE = 0x0002
+_PA_SUBSCRIPTION_MASK_CARD = 0x0200
+_PA_SUBSCRIPTION_EVENT_SINK = 0x0000
+_PA_SUBSCRIPTION_EVENT_SOURCE = 0x0001
+_PA_SUBSCRIPTION_EVENT_CARD = 0x0009
+_PA_SUBSCRIPTION_EVENT_FACILITY_MASK = 0x000f
+_PA_SUBSCRIPTION_EVENT_REMOVE = 0x0020
+_PA_SUBSCRIPTION_EVENT_TYPE_MASK = 0x0030
+
+_PA_CHANNELS_MAX = 32
+
+# pa_sink_state_t and pa_source_state_t, named as by pactl
+_device_states = {
+    0: 'RUNNING',
+    1: 'IDLE',
+    2: 'SUSPENDED',
+}
+
+_stream_states = {
+    0: 'UNCONNECTED',
+    1: 'CREATING',
+    _PA_STREAM_READY: 'READY',
+    _PA_STREAM_FAILED: 'FAILED',
+    _PA_STREAM_TERMINATED: 'TERMINATED',
+}
+
+class _SampleSpec(ctypes.Structure):
+    _fields_ = [('format', ctypes.c_int),
+                ('rate', ctypes.c_uint32),
+                ('channels', ctypes.c_uint8)]
+
+class _BufferAttr(ctypes.Structure):
+    _fields_ = [('maxlength', ctypes.c_uint32),
+                ('tlength', ctypes.c_uint32),
+                ('prebuf', ctypes.c_uint32),
+                ('minreq', ctypes.c_uint32),
+                ('fragsize', ctypes.c_uint32)]
+
+class _ChannelMap(ctypes.Structure):
+    _fields_ = [('channels', ctypes.c_uint8),
+                ('map', ctypes.c_int * _PA_CHANNELS_MAX)]
+
+class _CVolume(ctypes.Structure):
+    _fields_ = [('channels', ctypes.c_uint8),
+                ('values', ctypes.c_uint32 * _PA_CHANNELS_MAX)]
+
+class _DeviceInfo(ctypes.Structure):
+    '''
+    The leading part of pa_sink_info and pa_source_info, which are the same
+    up to the state field
+    '''
+    _fields_ = [('name', ctypes.c_char_p),
+                ('index', ctypes.c_uint32),
+                ('description', ctypes.c_char_p),
+                ('sample_spec', _SampleSpec),
+                ('channel_map', _ChannelMap),
+                ('owner_module', ctypes.c_uint32),
+                ('volume', _CVolume),
+                ('mute', ctypes.c_int),
+                ('monitor', ctypes.c_uint32),
+                ('monitor_name', ctypes.c_char_p),
+                ('latency', ctypes.c_uint64),
+                ('driver', ctypes.c_char_p),
+                ('flags', ctypes.c_int),
+                ('proplist', ctypes.c_void_p),
+                ('configured_latency', ctypes.c_uint64),
+                ('base_volume', ctypes.c_uint32),
+                ('state', ctypes.c_int)]
+
+class _CardProfileInfo(ctypes.Structure):
+    _fields_ = [('name', ctypes.c_char_p),
+                ('description', ctypes.c_char_p),
+                ('n_sinks', ctypes.c_uint32),
+                ('n_sources', ctypes.c_uint32),
+                ('priority', ctypes.c_uint32)]
+
+class _CardInfo(ctypes.Structure):
+    '''
+    The leading part of pa_card_info
+    '''
+    _fields_ = [('index', ctypes.c_uint32),
+                ('name', ctypes.c_char_p),
+                ('owner_module', ctypes.c_uint32),
+                ('driver', ctypes.c_char_p),
+                ('n_profiles', ctypes.c_uint32),
+                ('profiles', ctypes.POINTER(_CardProfileInfo)),
+                ('active_profile', ctypes.POINTER(_CardProfileInfo))]
+
+_notify_cb_t = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p)
+_request_cb_t = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.c_void_p)
+_success_cb_t = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_int,
+                                 ctypes.c_void_p)
+_subscribe_cb_t = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_uint32,
+                                   ctypes.c_uint32, ctypes.c_void_p)
+_device_info_cb_t = ctypes.CFUNCTYPE(None, ctypes.c_void_p,
+                                     ctypes.POINTER(_DeviceInfo),
+                                     ctypes.c_int, ctypes.c_void_p)
+_card_info_cb_t = ctypes.CFUNCTYPE(None, ctypes.c_void_p,
+                                   ctypes.POINTER(_CardInfo), ctypes.c_int,
+                                   ctypes.c_void_p)
+
+_lib = None
+
+def _libpulse():
+    global _lib
+    if _lib is not None:
+        return _lib
+
+    try:
+        lib = ctypes.CDLL('libpulse.so.0')
+    except OSError as e:
+        raise _Client.LoadError(e)
+
+    p = ctypes.c_void_p
+    signatures = {
+        'pa_threaded_mainloop_new': (p, []),
+        'pa_threaded_mainloop_free': (None, [p]),
+        'pa_threaded_mainloop_start': (ctypes.c_int, [p]),
+        'pa_threaded_mainloop_stop': (None, [p]),
+        'pa_threaded_mainloop_lock': (None, [p]),
+        'pa_threaded_mainloop_unlock': (None, [p]),
+        'pa_threaded_mainloop_wait': (None, [p]),
+        'pa_threaded_mainloop_signal': (None, [p, ctypes.c_int]),
+        'pa_threaded_mainloop_get_api': (p, [p]),
+        'pa_context_new': (p, [p, ctypes.c_char_p]),
+        'pa_context_unref': (None, [p]),
+        'pa_context_connect': (ctypes.c_int, [p, ctypes.c_char_p,
+                                              ctypes.c_int, p]),
+        'pa_context_disconnect': (None, [p]),
+        'pa_context_get_state': (ctypes.c_int, [p]),
+        'pa_context_errno': (ctypes.c_int, [p]),
+        'pa_context_set_state_callback': (None, [p, _notify_cb_t, p]),
+        'pa_context_set_subscribe_callback': (None, [p, _subscribe_cb_t, p]),
+        'pa_context_subscribe': (p, [p, ctypes.c_uint32, _success_cb_t, p]),
+        'pa_context_get_sink_info_list': (p, [p, _device_info_cb_t, p]),
+        'pa_context_get_sink_info_by_index': (p, [p, ctypes.c_uint32,
+                                                  _device_info_cb_t, p]),
+        'pa_context_get_source_info_list': (p, [p, _device_info_cb_t, p]),
+        'pa_context_get_source_info_by_index': (p, [p, ctypes.c_uint32,
+                                                    _device_info_cb_t, p]),
+        'pa_context_get_card_info_list': (p, [p, _card_info_cb_t, p]),
+        'pa_context_get_card_info_by_index': (p, [p, ctypes.c_uint32,
+                                                  _card_info_cb_t, p]),
+        'pa_context_set_card_profile_by_name': (p, [p, ctypes.c_char_p,
+                                                    ctypes.c_char_p,
+                                                    _success_cb_t, p]),
+        'pa_operation_get_state': (ctypes.c_int, [p]),
+        'pa_operation_unref': (None, [p]),
+        'pa_stream_new': (p, [p, ctypes.c_char_p,
+                              ctypes.POINTER(_SampleSpec), p]),
+        'pa_stream_unref': (None, [p]),
+        'pa_stream_connect_record': (ctypes.c_int,
+                                     [p, ctypes.c_char_p,
+                                      ctypes.POINTER(_BufferAttr),
+                                      ctypes.c_int]),
+        'pa_stream_disconnect': (ctypes.c_int, [p]),
+        'pa_stream_get_state': (ctypes.c_int, [p]),
+        'pa_stream_set_state_callback': (None, [p, _notify_cb_t, p]),
+        'pa_stream_set_read_callback': (None, [p, _request_cb_t, p]),
+        'pa_stream_peek': (ctypes.c_int, [p, ctypes.POINTER(p),
+                                          ctypes.POINTER(ctypes.c_size_t)]),
+        'pa_stream_drop': (ctypes.c_int, [p]),
+        'pa_strerror': (ctypes.c_char_p, [ctypes.c_int]),
+    }
+    for name, (restype, argtypes) in signatures.items():
+        function = getattr(lib, name)
+        function.restype = restype
+        function.argtypes = argtypes
+
+    _lib = lib
+    return _lib
+
+class _Client:
+    '''
+    Base for clients with their own connection and main loop thread
+    '''
+
+    _CLIENT_NAME = b'btts'
+
+    # Subclasses define their own Error
+
+    class LoadError(Exception):
+        def __init__(self, error):
+            Exception.__init__(self, 'Failed to load libpulse: %s' % (error))
+
+    def __init__(self):
+        self._mainloop = None
+        self._context = None
+
+        # Must stay referenced while in use by libpulse
+        self._context_state_cb = _notify_cb_t(self._on_context_state)
+
+    def _connect(self):
+        '''
+        Connect to the server. Returns with the main loop locked - call
+        _unlock() when done.
+        '''
+        try:
+            lib = _libpulse()
+        except _Client.LoadError as e:
+            raise self.Error(str(e))
+
+        self._mainloop = lib.pa_threaded_mainloop_new()
+        api = lib.pa_threaded_mainloop_get_api(self._mainloop)
+        self._context = lib.pa_context_new(api, self._CLIENT_NAME)
+        lib.pa_context_set_state_callback(self._context,
+                                          self._context_state_cb, None)
+
+        self._lock()
+        try:
+            if lib.pa_context_connect(self._context, None, 0, None) < 0:
+                self._fail('Failed to connect to PulseAudio')
+            if lib.pa_threaded_mainloop_start(self._mainloop) < 0:
+                self._fail('Failed to start PulseAudio main loop')
+            self._wait_state(lib.pa_context_get_state, self._context,
+                             _PA_CONTEXT_READY, (_PA_CONTEXT_FAILED,
+                                                 _PA_CONTEXT_TERMINATED),
+                             'Failed to connect to PulseAudio')
+        except self.Error:
+            self._unlock()
+            self._disconnect()
+            raise
+
+    def _disconnect(self, before=None):
+        '''
+        Release all resources. If given, 'before' is called with the main
+        loop locked before the context is disconnected.
+        '''
+        if self._mainloop is None:
+            return
+
+        lib = _libpulse()
+
+        self._lock()
+        if before is not None:
+            before()
+        if self._context:
+            lib.pa_context_disconnect(self._context)
+            lib.pa_context_unref(self._context)
+            self._context = None
+        self._unlock()
+
+        lib.pa_threaded_mainloop_stop(self._mainloop)
+        lib.pa_threaded_mainloop_free(self._mainloop)
+        self._mainloop = None
+
+    def _lock(self):
+        _libpulse().pa_threaded_mainloop_lock(self._mainloop)
+
+    def _unlock(self):
+        _libpulse().pa_threaded_mainloop_unlock(self._mainloop)
+
+    def _fail(self, message):
+        lib = _libpulse()
+        errno = lib.pa_context_errno(self._context) if self._context else 0
+        if errno:
+            message += ': ' + lib.pa_strerror(errno).decode('utf-8')
+        raise self.Error(message)
+
+    def _wait_state(self, get_state, obj, ready, failed, message):
+        # Called with the main loop locked
+        lib = _libpulse()
+        while True:
+            state = get_state(obj)
+            if state == ready:
+                return
+            if state in failed:
+                self._fail(message)
+            lib.pa_threaded_mainloop_wait(self._mainloop)
+
+    def _wait_operation(self, operation, message):
+        # Called with the main loop locked
+        lib = _libpulse()
+        if not operation:
+            self._fail(message)
+        while lib.pa_operation_get_state(operation) == _PA_OPERATION_RUNNING:
+            lib.pa_threaded_mainloop_wait(self._mainloop)
+        lib.pa_operation_unref(operation)
+
+    def _on_context_state(self, context, userdata):
+        _libpulse().pa_threaded_mainloop_signal(self._mainloop, 0)
+
+class RingBuffer:
+    '''
+    Preallocated byte ring buffer with a single writer and any number of
+    readers.
+
+    Readers get memoryviews of the buffer itself, no copies are made. A view
+    stays valid until 'capacity' more bytes are written - readers that fall
+    behind that far get OverrunError.
+    '''
+
+    class Error(Exception):
+        _dbus_error_name = 'org.merproject.btts.RingBuffer.Error'
+
+    class OverrunError(Error):
+        def __init__(self, lost):
+            RingBuffer.Error.__init__(self, 'Reader overrun, %d bytes lost'
+                                            % (lost))
+
+    def __init__(self, capacity):
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._c_buffer = (ctypes.c_char * capacity).from_buffer(self._buffer)
+        self._address = ctypes.addressof(self._c_buffer)
+        self._capacity = capacity
+        self._written = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def written(self):
+        '''
+        Total number of bytes written
+        '''
+        return self._written
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        for offset, dst, chunk in self._segments(len(view)):
+            self._view[dst:dst + chunk] = view[offset:offset + chunk]
+        self._commit(len(view))
+
+    def write_from(self, address, size):
+        '''
+        Write 'size' bytes from the memory at 'address'
+        '''
+        for offset, dst, chunk in self._segments(size):
+            ctypes.memmove(self._address + dst, address + offset, chunk)
+        self._commit(size)
+
+    def _segments(self, size):
+        offset = 0
+        while offset < size:
+            dst = (self._written + offset) % self._capacity
+            chunk = min(size - offset, self._capacity - dst)
+            yield offset, dst, chunk
+            offset += chunk
+
+    def _commit(self, size):
+        with self._cond:
+            self._written += size
+            self._cond.notify_all()
+
+    def close(self):
+        '''
+        Signal end of data to readers
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def reader(self, position=None):
+        '''
+        Returns a new Reader positioned at 'position' (counted in bytes
+        written) or at the oldest data available, whichever is newer.
+        '''
+        oldest = max(0, self._written - self._capacity)
+        if position is None:
+            position = oldest
+        return RingBuffer.Reader(self, max(oldest, position))
+
+    class Reader:
+        def __init__(self, ring, position):
+            self._ring = ring
+            self.position = position
+
+        @property
+        def at_end(self):
+            return self._ring.closed and self.position == self._ring.written
+
+        def wait(self, timeout=None):
+            '''
+            Wait for new data or end of data. Returns False on timeout.
+            '''
+            ring = self._ring
+            with ring._cond:
+                return ring._cond.wait_for(
+                        lambda: ring._written > self.position or ring._closed,
+                        timeout)
+
+        def read(self, max_size=None):
+            '''
+            Returns the list of (at most two) memoryviews with the data
+            written since the last call.
+            '''
+            ring = self._ring
+            written = ring.written
+            lost = written - ring.capacity - self.position
+            if lost > 0:
+                self.position += lost
+                raise RingBuffer.OverrunError(lost)
+
+            size = written - self.position
+            if max_size is not None:
+                size = min(size, max_size)
+
+            views = []
+            while size > 0:
+                start = self.position % ring.capacity
+                chunk = min(size, ring.capacity - start)
+                views.append(ring._view[start:start + chunk])
+                self.position += chunk
+                size -= chunk
+            return views
+
+class Capture(_Client):
+    '''
+    Records a PulseAudio source into a RingBuffer.
+
+    Signed 16 bit little endian PCM data is recorded, resampled and remixed by
+    the server as needed.
+
+    Leading silence is skipped the way `sox ... silence 1 <gate_duration>
+    <gate_threshold>` does it: recording starts with the first period of
+    'gate_duration' seconds throughout which the RMS level (measured in 20ms
+    blocks) stays above 'gate_threshold' (relative to full scale). Recording
+    finishes (the ring buffer gets closed) after 'duration' seconds, unless
+    it is 0.
+
+    With 'gap_threshold' (seconds) given, timing events are collected in
+    'timing' as (time, event, detail) triplets, time being time.monotonic()
+    at the estimated position of the event in the stream:
+
+        stream <state>  - record stream state changed
+        audio           - first non-silent sample, i.e. with level above
+                          'gate_threshold'
+        gap <duration>  - silence of at least 'gap_threshold' seconds after
+                          the first non-silent sample
+        hole <duration> - data lost by the server
+        end <reason>    - recording finished: "complete", "stopped" or
+                          "failed"
+    '''
+
+    _FRAGMENT = 0.1 # seconds
+    _GATE_BLOCK = 0.02 # seconds
+    _STREAM_NAME = b'btts-record'
+
+    class Error(Exception):
+        _dbus_error_name = 'org.merproject.btts.Capture.Error'
+
+    def __init__(self, device, rate=44100, channels=2, capacity=60,
+                 duration=0, gate_duration=0, gate_threshold=0,
+                 gap_threshold=None):
+        _Client.__init__(self)
+
+        # Pulls in numpy - only when needed
+        import numpy as np
+        self._np = np
+
+        self.device = device
+        self.rate = rate
+        self.channels = channels
+        self.frame_size = 2 * channels
+        self.ring = RingBuffer(int(capacity * rate) * self.frame_size)
+
+        self._max_frames = int(duration * rate)
+        self._gate_size = int(gate_duration * rate) * self.frame_size
+        self._gate_block = max(1, int(self._GATE_BLOCK * rate)) * self.frame_size
+        self._gate_level = gate_threshold * 32768
+        self._gate_open = self._gate_size == 0
+        self._pending = bytearray()
+        self._checked = 0
+
+        self.timing = []
+        self._gap_threshold = gap_threshold
+        self._scan_pending = bytearray()
+        self._first_audio = None
+        self._silence_start = None
+        self._silent_blocks = 0
+
+        self._frames = 0
+        self._received = 0
+        self._start_time = None
+        self._ready = False
+        self._stream = None
+        self._error = None
+
+        # Must stay referenced while in use by libpulse
+        self._stream_state_cb = _notify_cb_t(self._on_stream_state)
+        self._read_cb = _request_cb_t(self._on_read)
+
+    @property
+    def duration(self):
+        '''
+        Duration of the audio recorded so far (seconds)
+        '''
+        return self._frames / self.rate
+
+    @property
+    def finished(self):
+        return self.ring.closed
+
+    @property
+    def start_time(self):
+        '''
+        Estimated time.monotonic() when the first sample received was
+        recorded, or None. With no gate (zero 'gate_duration') it is the time
+        of the first sample in the ring buffer.
+        '''
+        return self._start_time
+
+    @property
+    def error(self):
+        '''
+        Error message if the stream failed while recording or None
+        '''
+        return self._error
+
+    def start(self):
+        self._connect()
+        lib = _libpulse()
+        try:
+            spec = _SampleSpec(_PA_SAMPLE_S16LE, self.rate, self.channels)
+            self._stream = lib.pa_stream_new(self._context, self._STREAM_NAME,
+                                             ctypes.byref(spec), None)
+            if not self._stream:
+                self._fail('Failed to create record stream')
+            lib.pa_stream_set_state_callback(self._stream,
+                                             self._stream_state_cb, None)
+            lib.pa_stream_set_read_callback(self._stream, self._read_cb,
+                                            None)
+
+            # Like parec, no PA_STREAM_INTERPOLATE_TIMING and no
+            # PA_STREAM_ADJUST_LATENCY. Only the fragment size is set so the
+            # data does not come in (default) two second chunks.
+            fragsize = int(self._FRAGMENT * self.rate) * self.frame_size
+            attr = _BufferAttr(0xffffffff, 0xffffffff, 0xffffffff,
+                               0xffffffff, fragsize)
+            if lib.pa_stream_connect_record(self._stream,
+                                            self.device.encode('utf-8'),
+                                            ctypes.byref(attr), 0) < 0:
+                self._fail('%s: Failed to connect record stream'
+                           % (self.device))
+            self._wait_state(lib.pa_stream_get_state, self._stream,
+                             _PA_STREAM_READY, (_PA_STREAM_FAILED,
+                                                _PA_STREAM_TERMINATED),
+                             '%s: Failed to connect record stream'
+                             % (self.device))
+            self._ready = True
+        except Capture.Error:
+            self._unlock()
+            self.stop()
+            raise
+        self._unlock()
+
+    def stop(self):
+        '''
+        Stop recording and release all resources. The ring buffer gets closed
+        and stays readable.
+        '''
+        self._disconnect(before=self._disconnect_stream)
+        self._close('stopped')
+
+    def _close(self, reason):
+        if self.ring.closed:
+            return
+        if self._gap_threshold is not None:
+            self._end_silence()
+            self.timing.append((time.monotonic(), 'end', reason))
+        self.ring.close()
+
+    def _disconnect_stream(self):
+        if self._stream:
+            lib = _libpulse()
+            lib.pa_stream_disconnect(self._stream)
+            lib.pa_stream_unref(self._stream)
+            self._stream = None
+
+    def wait(self, timeout=None):
+        '''
+        Wait for the recording to finish. Returns False on timeout.
+        '''
+        with self.ring._cond:
+            return self.ring._cond.wait_for(lambda: self.ring.closed,
+                                            timeout)
+
+    def _on_stream_state(self, stream, userdata):
+        lib = _libpulse()
+        state = lib.pa_stream_get_state(stream)
+        if self._gap_threshold is not None:
+            self.timing.append((time.monotonic(), 'stream',
+                                _stream_states.get(state, str(state))))
+        if self._ready and state == _PA_STREAM_FAILED:
+            self._error = '%s: Record stream failed' % (self.device)
+            log.warning(self._error)
+            self._close('failed')
+        lib.pa_threaded_mainloop_signal(self._mainloop, 0)
+
+    def _on_read(self, stream, nbytes, userdata):
+        lib = _libpulse()
+        data = ctypes.c_void_p()
+        size = ctypes.c_size_t()
+        while True:
+            if lib.pa_stream_peek(stream, ctypes.byref(data),
+                                  ctypes.byref(size)) < 0:
+                self._error = '%s: Failed to read record stream' % (self.device)
+                log.warning(self._error)
+                self._close('failed')
+                return
+            if size.value == 0:
+                return
+            # NULL data means a hole in the stream - skipped like parec does
+            if data.value is None:
+                if self._gap_threshold is not None:
+                    self.timing.append((time.monotonic(), 'hole', '%.3f'
+                                        % (size.value / self.frame_size
+                                           / self.rate)))
+            elif not self.ring.closed:
+                self._update_start_time(size.value)
+                if self._gap_threshold is not None:
+                    self._scan(ctypes.string_at(data.value, size.value))
+                self._feed(data.value, size.value)
+            lib.pa_stream_drop(stream)
+
+    def _update_start_time(self, size):
+        # Data never arrive earlier than recorded, so the earliest estimate
+        # is the best one
+        self._received += size
+        start_time = (time.monotonic()
+                      - self._received / (self.rate * self.frame_size))
+        if self._start_time is None or start_time < self._start_time:
+            self._start_time = start_time
+
+    def _feed(self, address, size):
+        if not self._gate_open:
+            self._pending += ctypes.string_at(address, size)
+            self._check_gate()
+            if not self._gate_open:
+                return
+            pending, self._pending = self._pending, bytearray()
+            self._write(pending, len(pending))
+        else:
+            self._write(address, size)
+
+    def _check_gate(self):
+        np = self._np
+        while len(self._pending) - self._checked >= self._gate_block:
+            block = np.frombuffer(self._pending[self._checked:self._checked
+                                                + self._gate_block],
+                                  dtype='<i2')
+            rms = np.sqrt(np.mean(block.astype(np.float32) ** 2))
+            if rms > self._gate_level:
+                self._checked += self._gate_block
+                if self._checked >= self._gate_size:
+                    self._gate_open = True
+                    return
+            else:
+                del self._pending[:self._checked + self._gate_block]
+                self._checked = 0
+
+    def _write(self, source, size):
+        frames = size // self.frame_size
+        if self._max_frames > 0:
+            frames = min(frames, self._max_frames - self._frames)
+        size = frames * self.frame_size
+
+        if isinstance(source, int):
+            self.ring.write_from(source, size)
+        else:
+            self.ring.write(memoryview(source)[:size])
+        self._frames += frames
+
+        if self._max_frames > 0 and self._frames >= self._max_frames:
+            self._close('complete')
+
+    def _scan(self, data):
+        '''
+        Collect timing events of the just received 'data'
+        '''
+        np = self._np
+        now = time.monotonic()
+        self._scan_pending += data
+        count = len(self._scan_pending) // self._gate_block
+        if count == 0:
+            return
+        size = count * self._gate_block
+        blocks = np.frombuffer(bytes(self._scan_pending[:size]), dtype='<i2')
+        levels = np.sqrt(np.mean(blocks.reshape(count, -1)
+                                 .astype(np.float32) ** 2, axis=1))
+        del self._scan_pending[:size]
+
+        byte_rate = self.rate * self.frame_size
+        block_time = self._gate_block / byte_rate
+        # Received data end 'now', the unscanned rest comes last
+        end = now - len(self._scan_pending) / byte_rate
+        for i, level in enumerate(levels.tolist()):
+            block_start = end - (count - i) * block_time
+            if level > self._gate_level:
+                if self._first_audio is None:
+                    self._first_audio = block_start
+                    self.timing.append((block_start, 'audio', ''))
+                self._end_silence()
+            elif self._first_audio is not None:
+                if self._silence_start is None:
+                    self._silence_start = block_start
+                self._silent_blocks += 1
+
+    def _end_silence(self):
+        if self._silence_start is None:
+            return
+        # Measured in samples, arrival times jitter
+        duration = (self._silent_blocks * self._gate_block
+                    / (self.rate * self.frame_size))
+        self._silent_blocks = 0
+        if duration >= self._gap_threshold:
+            self.timing.append((self._silence_start, 'gap',
+                                '%.3f' % (duration)))
+        self._silence_start = None
+
+class Tracker(_Client):
+    '''
+    Process-wide mirror of the state of the Bluetooth cards, sources and sinks
+    (those named "bluez_*") of the server.
+
+    Populated once on start and kept current through the server's
+    subscription events. Use Tracker.instance().
+    '''
+
+    _PREFIX = 'bluez_'
+    _MAX_TRANSITIONS = 1000
+
+    class Error(Exception):
+        _dbus_error_name = 'org.merproject.btts.Tracker.Error'
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None or cls._instance._failed:
+            tracker = Tracker()
+            tracker._start()
+            cls._instance = tracker
+        return cls._instance
+
+    def __init__(self):
+        _Client.__init__(self)
+
+        self._cond = threading.Condition()
+        self._sinks = {}
+        self._sources = {}
+        self._cards = {}
+        # Names by (facility, index), to handle removals
+        self._names = {}
+        # (time, name, value) triplets
+        self._transitions = collections.deque(maxlen=self._MAX_TRANSITIONS)
+        self._pending = 0
+        self._success = False
+        self._ready = False
+        self._failed = False
+
+        # Must stay referenced while in use by libpulse
+        self._subscribe_cb = _subscribe_cb_t(self._on_event)
+        self._success_cb = _success_cb_t(self._on_success)
+        self._sink_info_cb = _device_info_cb_t(self._on_sink_info)
+        self._source_info_cb = _device_info_cb_t(self._on_source_info)
+        self._card_info_cb = _card_info_cb_t(self._on_card_info)
+
+    def sink_state(self, name):
+        '''
+        Returns the state of the sink ("RUNNING", "IDLE" or "SUSPENDED") or
+        None if there is no such sink.
+        '''
+        with self._cond:
+            return self._sinks.get(name)
+
+    def source_state(self, name):
+        '''
+        Returns the state of the source ("RUNNING", "IDLE" or "SUSPENDED") or
+        None if there is no such source.
+        '''
+        with self._cond:
+            return self._sources.get(name)
+
+    def card_profile(self, name):
+        '''
+        Returns the name of the active profile of the card or None if there
+        is no such card.
+        '''
+        with self._cond:
+            return self._cards.get(name)
+
+    def transitions(self, name, since=0):
+        '''
+        Returns the list of (time, state) pairs recording the changes of the
+        state (the active profile for cards) of the named card, source or
+        sink since 'since', both times being time.monotonic(). The state is
+        None when it was removed.
+        '''
+        with self._cond:
+            return [(when, value) for when, changed, value in self._transitions
+                    if changed == name and when >= since]
+
+    def wait_for(self, predicate, timeout=None):
+        '''
+        Wait until 'predicate' (called with no arguments) returns true,
+        reevaluating it on each change. Returns False on timeout.
+        '''
+        with self._cond:
+            return self._cond.wait_for(predicate, timeout)
+
+    def set_card_profile(self, card, profile):
+        lib = _libpulse()
+        self._lock()
+        try:
+            self._success = False
+            operation = lib.pa_context_set_card_profile_by_name(
+                    self._context, card.encode('utf-8'),
+                    profile.encode('utf-8'), self._success_cb, None)
+            self._wait_operation(operation, '%s: Failed to set card profile'
+                                            % (card))
+            if not self._success:
+                self._fail('%s: Failed to set card profile %s'
+                           % (card, profile))
+        finally:
+            self._unlock()
+
+        with self._cond:
+            if self._cards.get(card) != profile:
+                self._transitions.append((time.monotonic(), card, profile))
+            self._cards[card] = profile
+            self._cond.notify_all()
+
+    def _start(self):
+        self._connect()
+        lib = _libpulse()
+        try:
+            # Subscribe first so no change is lost in between
+            lib.pa_context_set_subscribe_callback(self._context,
+                                                  self._subscribe_cb, None)
+            self._success = False
+            operation = lib.pa_context_subscribe(
+                    self._context,
+                    _PA_SUBSCRIPTION_MASK_SINK | _PA_SUBSCRIPTION_MASK_SOURCE
+                    | _PA_SUBSCRIPTION_MASK_CARD,
+                    self._success_cb, None)
+            self._wait_operation(operation, 'Failed to subscribe to events')
+            if not self._success:
+                self._fail('Failed to subscribe to events')
+
+            self._pending = 3
+            for get_list, callback in (
+                    (lib.pa_context_get_sink_info_list, self._sink_info_cb),
+                    (lib.pa_context_get_source_info_list,
+                     self._source_info_cb),
+                    (lib.pa_context_get_card_info_list, self._card_info_cb)):
+                operation = get_list(self._context, callback, None)
+                if not operation:
+                    self._fail('Failed to list devices')
+                lib.pa_operation_unref(operation)
+            while self._pending > 0:
+                lib.pa_threaded_mainloop_wait(self._mainloop)
+
+            self._ready = True
+        except Tracker.Error:
+            self._unlock()
+            self._disconnect()
+            raise
+        self._unlock()
+
+    def _table(self, facility):
+        return {_PA_SUBSCRIPTION_EVENT_SINK: self._sinks,
+                _PA_SUBSCRIPTION_EVENT_SOURCE: self._sources,
+                _PA_SUBSCRIPTION_EVENT_CARD: self._cards}[facility]
+
+    def _update(self, facility, index, name, value):
+        if not name.startswith(self._PREFIX):
+            return
+        with self._cond:
+            self._names[(facility, index)] = name
+            table = self._table(facility)
+            if name not in table or table[name] != value:
+                self._transitions.append((time.monotonic(), name, value))
+            table[name] = value
+            self._cond.notify_all()
+
+    def _remove(self, facility, index):
+        with self._cond:
+            name = self._names.pop((facility, index), None)
+            if name is None:
+                return
+            self._table(facility).pop(name, None)
+            self._transitions.append((time.monotonic(), name, None))
+            self._cond.notify_all()
+
+    def _on_context_state(self, context, userdata):
+        lib = _libpulse()
+        if (self._ready and lib.pa_context_get_state(context)
+                in (_PA_CONTEXT_FAILED, _PA_CONTEXT_TERMINATED)):
+            log.warning('Connection to PulseAudio lost')
+            self._failed = True
+            with self._cond:
+                self._cond.notify_all()
+        lib.pa_threaded_mainloop_signal(self._mainloop, 0)
+
+    def _on_success(self, context, success, userdata):
+        self._success = bool(success)
+        _libpulse().pa_threaded_mainloop_signal(self._mainloop, 0)
+
+    def _on_event(self, context, event, index, userdata):
+        lib = _libpulse()
+        facility = event & _PA_SUBSCRIPTION_EVENT_FACILITY_MASK
+        if (event & _PA_SUBSCRIPTION_EVENT_TYPE_MASK
+                == _PA_SUBSCRIPTION_EVENT_REMOVE):
+            self._remove(facility, index)
+            return
+
+        if facility == _PA_SUBSCRIPTION_EVENT_SINK:
+            operation = lib.pa_context_get_sink_info_by_index(
+                    context, index, self._sink_info_cb, None)
+        elif facility == _PA_SUBSCRIPTION_EVENT_SOURCE:
+            operation = lib.pa_context_get_source_info_by_index(
+                    context, index, self._source_info_cb, None)
+        elif facility == _PA_SUBSCRIPTION_EVENT_CARD:
+            operation = lib.pa_context_get_card_info_by_index(
+                    context, index, self._card_info_cb, None)
+        else:
+            return
+        if operation:
+            self._pending += 1
+            lib.pa_operation_unref(operation)
+
+    def _on_info_end(self):
+        self._pending -= 1
+        _libpulse().pa_threaded_mainloop_signal(self._mainloop, 0)
+
+    def _on_sink_info(self, context, info, eol, userdata):
+        self._on_device_info(_PA_SUBSCRIPTION_EVENT_SINK, info, eol)
+
+    def _on_source_info(self, context, info, eol, userdata):
+        self._on_device_info(_PA_SUBSCRIPTION_EVENT_SOURCE, info, eol)
+
+    def _on_device_info(self, facility, info, eol):
+        if eol:
+            self._on_info_end()
+            return
+        info = info.contents
+        self._update(facility, info.index, info.name.decode('utf-8'),
+                     _device_states.get(info.state))
+
+    def _on_card_info(self, context, info, eol, userdata):
+        if eol:
+            self._on_info_end()
+            return
+        info = info.contents
+        profile = None
+        if info.active_profile:
+            profile = info.active_profile.contents.name.decode('utf-8')
+        self._update(_PA_SUBSCRIPTION_EVENT_CARD, info.index,
+                     info.name.decode('utf-8'), profile)
@@ -0,0 +1,114 @@
+#
+# BTTS - BlueTooth Test Suite
+#
+# Copyright (C) 2014 Jolla Ltd.
+# Contact: Martin Kampas <martin.kampas@jollamobile.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Named sessions, so that one node can work with several devices at a time,
+each through its own adapter.
+
+The session is selected with the BTTS_SESSION environment variable (set by
+the btts utility with its '--session' option). When unset or empty, the
+default session is used - the one that existed before sessions did.
+
+Each named session has its own
+    - adapter, host alias and device settings, see btts.Config,
+    - instance of the tool servers, see server_bus(), bus_name() and
+      object_path(),
+    - paths for the files the tools produce, see artifact_path().
+
+Audio sources follow from the device setting. The audio injection sink, the
+bluez agent and the OPP server tool are shared by all sessions.
+'''
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import re
+
+ENV_VARIABLE = 'BTTS_SESSION'
+
+# Usable as a D-Bus bus name element, object path element and GSettings
+# path element alike. Keep in sync with src/btts.
+_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+_ARTIFACT_DIR = '/tmp'
+_SESSION_ARTIFACT_DIR = '/tmp/btts-session-%s'
+
+class Error(Exception):
+    _dbus_error_name = 'org.merproject.btts.Session.Error'
+
+class InvalidNameError(Error):
+    def __init__(self, name):
+        Error.__init__(self, '%s: Not a valid session name' % (name))
+        self.name = name
+
+def is_valid_name(name):
+    return bool(_NAME_RE.match(name))
+
+def name():
+    '''
+    Returns the name of the current session, empty for the default session.
+    '''
+    session = os.environ.get(ENV_VARIABLE, '')
+    if session and not is_valid_name(session):
+        raise InvalidNameError(session)
+    return session
+
+def is_default():
+    return not name()
+
+def server_bus(default_bus):
+    '''
+    Returns the bus the tool servers of the current session are on.
+
+    Tool servers of the default session stay on 'default_bus'. Those of named
+    sessions are on the BTTS bus (see btts-dbus.service), where any bus name
+    may be owned.
+    '''
+    if is_default():
+        return default_bus
+    import dbus
+    return dbus.SessionBus()
+
+def bus_name(bus_name):
+    '''
+    Returns the bus name of the given tool server in the current session
+    '''
+    session = name()
+    return bus_name + '.' + session if session else bus_name
+
+def object_path(path):
+    '''
+    Returns the object path of the given tool server in the current session
+    '''
+    session = name()
+    return path + '/' + session if session else path
+
+def artifact_path(path):
+    '''
+    Returns the path to use for the given file (or directory) under /tmp in
+    the current session. The session directory is created as needed.
+    '''
+    session = name()
+    if not session:
+        return path
+    relative = os.path.relpath(path, _ARTIFACT_DIR)
+    if relative.startswith(os.pardir):
+        raise ValueError('%s: Not under %s' % (path, _ARTIFACT_DIR))
+    session_dir = _SESSION_ARTIFACT_DIR % (session)
+    os.makedirs(session_dir, exist_ok=True)
+    return os.path.join(session_dir, relative)
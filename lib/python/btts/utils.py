@@ -19,7 +19,6 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 from functools import wraps
-import dbus.service
 import io
 import logging
 import sys
@@ -27,6 +26,7 @@ import sys
 log = logging.getLogger(__name__)
 
 def dbus_service_method(dbus_interface, **kwargs):
+	import dbus.service
 	def ctor(func):
 		dbus_wrapped = dbus.service.method(dbus_interface, **kwargs)(func)
 		@wraps(func)
@@ -44,6 +44,7 @@ def dbus_service_method(dbus_interface, **kwargs):
 	return ctor
 
 def dbus_service_signal(dbus_interface, **kwargs):
+	import dbus.service
 	def ctor(func):
 		dbus_wrapped = dbus.service.signal(dbus_interface, **kwargs)(func)
 		@wraps(func)
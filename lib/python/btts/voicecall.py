@@ -16,32 +16,46 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import dbus
+import logging
 
 import btts
 
+log = logging.getLogger(__name__)
+
+OFONO_BUS_NAME = 'org.ofono'
+
 class VoiceCall:
     class Error(Exception):
-        pass
+        _dbus_error_name = 'org.merproject.btts.VoiceCall.Error'
 
     class NotReadyError(Error):
         def __init__(self):
             VoiceCall.Error.__init__(self, 'Not ready')
 
-    def __init__(self):
+    def __init__(self, modem_path=None):
+        '''
+        Uses the HFP modem of the device, unless the modem is given with
+        'modem_path' (e.g. as found by CallTracker)
+        '''
+        import dbus
         bus = dbus.SystemBus()
-        manager = dbus.Interface(bus.get_object('org.ofono', '/'),
-                                 'org.ofono.Manager')
 
         self._modem_object = None
 
+        if modem_path is not None:
+            self._modem_object = bus.get_object(OFONO_BUS_NAME, modem_path)
+            return
+
+        manager = dbus.Interface(bus.get_object(OFONO_BUS_NAME, '/'),
+                                 'org.ofono.Manager')
+
         device_address = btts.Config().device.upper()
         modems = manager.GetModems()
         for path, properties in modems:
             try:
                 if (properties['Type'] == 'hfp' and
                         properties['Serial'] == device_address):
-                    self._modem_object = bus.get_object('org.ofono', path)
+                    self._modem_object = bus.get_object(OFONO_BUS_NAME, path)
                     break
             except KeyError:
                 pass
@@ -58,3 +72,199 @@ class VoiceCall:
     def _ensure_ready(self):
         if not self._modem_object:
             raise self.NotReadyError()
+
+class CallTracker:
+    '''
+    Process-wide mirror of the oFono HFP modems and their voice calls.
+
+    Populated with GetModems and GetCalls calls and kept current through the
+    oFono signals (as long as the main loop is running), also across oFono
+    restarts. Use CallTracker.instance().
+    '''
+
+    class CallState:
+        unavailable = 'unavailable' # no HFP modem for the device
+        idle = 'idle' # no call
+        # The rest as reported by oFono
+        incoming = 'incoming'
+        waiting = 'waiting'
+        dialing = 'dialing'
+        alerting = 'alerting'
+        active = 'active'
+        held = 'held'
+        disconnected = 'disconnected'
+    # With more calls, the state of the call first in this list is reported
+    call_states = [CallState.unavailable, CallState.idle, CallState.incoming,
+                   CallState.waiting, CallState.dialing, CallState.alerting,
+                   CallState.active, CallState.held, CallState.disconnected]
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = CallTracker()
+        return cls._instance
+
+    def __init__(self):
+        import btts.bus
+        self._bus = btts.bus.system_bus()
+
+        # Properties by modem path
+        self._modems = {}
+        # Properties by call path, by modem path
+        self._calls = {}
+
+        # Subscribe first so no change is lost in between
+        for handler, interface, signal_name in (
+                (self._on_modem_added, 'org.ofono.Manager', 'ModemAdded'),
+                (self._on_modem_removed, 'org.ofono.Manager', 'ModemRemoved'),
+                (self._on_modem_property_changed, 'org.ofono.Modem',
+                 'PropertyChanged'),
+                (self._on_call_added, 'org.ofono.VoiceCallManager',
+                 'CallAdded'),
+                (self._on_call_removed, 'org.ofono.VoiceCallManager',
+                 'CallRemoved'),
+                (self._on_call_property_changed, 'org.ofono.VoiceCall',
+                 'PropertyChanged')):
+            self._bus.add_signal_receiver(handler,
+                                          bus_name=OFONO_BUS_NAME,
+                                          dbus_interface=interface,
+                                          signal_name=signal_name,
+                                          path_keyword='path')
+        self._bus.add_signal_receiver(self._on_name_owner_changed,
+                                      bus_name='org.freedesktop.DBus',
+                                      dbus_interface='org.freedesktop.DBus',
+                                      signal_name='NameOwnerChanged',
+                                      arg0=OFONO_BUS_NAME)
+
+        self._populate()
+
+    def modem_path(self, address):
+        '''
+        Returns the object path of the HFP modem of the device with the
+        given address or None.
+        '''
+        address = address.upper()
+        for path, properties in self._modems.items():
+            if (properties.get('Type') == 'hfp'
+                    and properties.get('Serial') == address):
+                return path
+        return None
+
+    def calls(self, modem_path):
+        '''
+        Returns dictionary of call properties by call object path
+        '''
+        return dict(self._calls.get(modem_path, {}))
+
+    def call_state(self, address):
+        '''
+        Returns one of call_states for the device with the given address
+        '''
+        modem_path = self.modem_path(address)
+        if modem_path is None:
+            return self.CallState.unavailable
+        states = [properties.get('State')
+                  for properties in self._calls.get(modem_path, {}).values()]
+        for state in self.call_states:
+            if state in states:
+                return state
+        return self.CallState.idle
+
+    @btts.utils.signal
+    def changed(self):
+        '''
+        Emitted on any change of the modems or their calls
+        '''
+        pass
+
+    def _populate(self):
+        import dbus
+        self._modems.clear()
+        self._calls.clear()
+        # Not running oFono is like no modems - it is followed once started
+        try:
+            manager = dbus.Interface(self._bus.get_object(OFONO_BUS_NAME, '/'),
+                                     'org.ofono.Manager')
+            modems = manager.GetModems()
+        except dbus.DBusException as e:
+            log.warning('Failed to list oFono modems: %s' % (e))
+            return
+        for path, properties in modems:
+            self._add_modem(path, properties)
+
+    def _add_modem(self, path, properties):
+        self._modems[path] = dict(properties)
+        self._update_calls(path)
+
+    def _update_calls(self, modem_path):
+        '''
+        (Re)read the calls when the modem gains the VoiceCallManager
+        interface, forget them when it loses it
+        '''
+        import dbus
+        properties = self._modems.get(modem_path, {})
+        if 'org.ofono.VoiceCallManager' not in properties.get('Interfaces',
+                                                              []):
+            self._calls.pop(modem_path, None)
+            return
+        if modem_path in self._calls:
+            return
+
+        try:
+            manager = dbus.Interface(self._bus.get_object(OFONO_BUS_NAME,
+                                                          modem_path),
+                                     'org.ofono.VoiceCallManager')
+            calls = manager.GetCalls()
+        except dbus.DBusException as e:
+            log.warning('%s: Failed to list calls: %s' % (modem_path, e))
+            return
+        self._calls[modem_path] = {path: dict(properties)
+                                   for path, properties in calls}
+
+    def _on_name_owner_changed(self, name, old_owner, new_owner):
+        if new_owner:
+            self._populate()
+        else:
+            self._modems.clear()
+            self._calls.clear()
+        self.changed()
+
+    def _on_modem_added(self, modem_path, properties, path):
+        self._add_modem(modem_path, properties)
+        self.changed()
+
+    def _on_modem_removed(self, modem_path, path):
+        self._modems.pop(modem_path, None)
+        self._calls.pop(modem_path, None)
+        self.changed()
+
+    def _on_modem_property_changed(self, name, value, path):
+        properties = self._modems.get(path)
+        if properties is None:
+            return
+        properties[name] = value
+        if name == 'Interfaces':
+            self._update_calls(path)
+        self.changed()
+
+    def _on_call_added(self, call_path, properties, path):
+        calls = self._calls.get(path)
+        if calls is None:
+            return
+        calls[call_path] = dict(properties)
+        self.changed()
+
+    def _on_call_removed(self, call_path, path):
+        calls = self._calls.get(path)
+        if calls is None or calls.pop(call_path, None) is None:
+            return
+        self.changed()
+
+    def _on_call_property_changed(self, name, value, path):
+        for calls in self._calls.values():
+            if path in calls:
+                calls[path][name] = value
+                self.changed()
+                return
@@ -2,3 +2,9 @@
 
 export DBUS_SESSION_BUS_ADDRESS
 export PULSE_SERVER
+export BTTS_COMMAND_SOCKET
+export BTTS_FINGERPRINT_BACKEND
+export BTTS_RECORDER_BACKEND
+export BTTS_RECORDER_GAP_THRESHOLD
+export BTTS_VERIFY_WORKERS
+export BTTS_VERIFY_QUEUE_DEPTH